@@ -7,17 +7,26 @@
 """
 from trytond.pool import Pool
 from party import Address
+from product import Uom
+from currency import Currency
 from carrier import Carrier, UPSService
 from sale import Configuration, Sale, SaleLine
 from stock import (
     ShipmentOut, StockMove, GenerateUPSLabelMessage, GenerateUPSLabel,
 )
 from configuration import UPSConfiguration
+from cache import RateCache
+from rate_limit import RateLimit
+from rate_table import RateZone, RateChart
+from rating_job import RatingJob
+from capture import Capture
 
 
 def register():
     Pool.register(
         Address,
+        Uom,
+        Currency,
         SaleLine,
         Carrier,
         UPSService,
@@ -27,6 +36,12 @@ def register():
         StockMove,
         ShipmentOut,
         GenerateUPSLabelMessage,
+        RateCache,
+        RateLimit,
+        RateZone,
+        RateChart,
+        RatingJob,
+        Capture,
         module='ups', type_='model'
     )
     Pool.register(
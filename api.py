@@ -0,0 +1,801 @@
+# -*- coding: utf-8 -*-
+"""
+    api.py
+
+    Helpers to talk to the UPS API.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import errno
+import httplib
+import random
+import select
+import socket
+import sys
+import time
+import urllib2
+from contextlib import contextmanager
+from copy import deepcopy
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock, local
+from urlparse import urlparse
+
+from lxml import etree
+from ups.base import PyUPSException
+from ups.shipping_package import ShipmentConfirm, ShipmentAccept, ShipmentVoid
+from ups.rating_package import RatingService
+
+from .metrics import metrics
+from .profiling import phase
+from .response import parse_rate_response, parse_shipment_response
+
+__all__ = [
+    'request_many', 'connection_pool', 'get_client', 'single_flight',
+    'call_with_retry', 'CircuitOpenError', 'rate_limiter', 'batch_priority',
+    'capture_into', 'NETWORK_ERRORS',
+]
+
+#: Errors raised when UPS can not be reached or does not answer in time
+NETWORK_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+#: Seconds to wait for UPS to answer a request
+TIMEOUT = 10
+
+#: Seconds to wait for UPS to answer, per call type
+TIMEOUTS = {
+    'rate': 10,
+    'confirm': 20,
+    'accept': 30,
+    'void': 20,
+}
+
+#: Extra attempts made after a transient failure, per call type
+RETRIES = {
+    'rate': 2,
+    'confirm': 2,
+    'accept': 2,
+    'void': 2,
+}
+
+#: Call types which are not retried on network errors, as UPS may have
+#: processed the request whose answer was lost
+NOT_IDEMPOTENT = ('accept',)
+
+#: Bounds in seconds of the exponential backoff between attempts
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 4
+
+#: Consecutive failures after which the circuit of a call type opens
+CIRCUIT_THRESHOLD = 5
+
+#: Seconds during which an open circuit fails fast before letting a
+#: single request probe UPS again
+CIRCUIT_RESET_TIMEOUT = 30
+
+#: Part of a rate limit bucket kept for the interactive requests
+BATCH_RESERVE = 0.25
+
+#: Seconds of requests a process takes at once from a shared rate limit
+#: bucket
+SHARED_RESERVATION = 0.25
+
+#: Seconds after which an idle connection is not reused
+IDLE_TIMEOUT = 30
+
+#: Maximum number of idle connections kept per host
+MAX_IDLE = 10
+
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of keep-alive HTTPS connections to the UPS hosts,
+    which saves the TCP and TLS handshakes on all but the first request.
+    """
+
+    #: Class of the connections, HTTPS as UPS only answers on HTTPS
+    connection_class = httplib.HTTPSConnection
+
+    def __init__(self, timeout=TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                 max_idle=MAX_IDLE):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = Lock()
+
+    def acquire(self, host):
+        """
+        Return a healthy idle connection to the host or a new one
+        """
+        now = time.time()
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            while idle:
+                connection, last_used = idle.pop()
+                if now - last_used < self.idle_timeout \
+                        and self._is_healthy(connection):
+                    return connection
+                connection.close()
+        return self.connection_class(host, timeout=self.timeout)
+
+    def release(self, host, connection):
+        """
+        Give back a connection whose response has been completely read
+        """
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def clear(self):
+        with self._lock:
+            for idle in self._idle.itervalues():
+                for connection, _ in idle:
+                    connection.close()
+            self._idle.clear()
+
+    @staticmethod
+    def _is_healthy(connection):
+        """
+        An idle connection must be open and have nothing to read, else the
+        server closed it or sent garbage.
+        """
+        if connection.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (select.error, socket.error):
+            return False
+        return not readable
+
+    def post(self, url, data, timeout=None):
+        """
+        Post the data to the url and return the body of the response
+
+        The request is sent again on a new connection only if the server
+        had closed the kept alive connection before reading it. Any other
+        failure, and above all a timeout, is raised as UPS may have
+        processed the request.
+
+        :param timeout: Seconds to wait for the answer instead of the
+                        timeout of the pool
+        """
+        url = urlparse(url)
+        timeout = timeout or self.timeout
+        connection = self.acquire(url.netloc)
+        reused = connection.sock is not None
+        try:
+            response = self._post(connection, url.path, data, timeout)
+        except (httplib.BadStatusLine, socket.error), e:
+            if not reused or not self._is_stale(e):
+                raise
+            connection = self.connection_class(url.netloc, timeout=timeout)
+            response = self._post(connection, url.path, data, timeout)
+
+        body = self._read(url.netloc, connection, response)
+        if not 200 <= response.status < 300:
+            raise urllib2.HTTPError(
+                url.geturl(), response.status, response.reason,
+                response.msg, None
+            )
+        return body
+
+    @staticmethod
+    def _is_stale(error):
+        """
+        Return True if the error tells that the server closed the kept
+        alive connection while it was idle: the request could not be
+        written or no response at all came back
+        """
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        if isinstance(error, socket.timeout):
+            return False
+        return getattr(error, 'errno', None) in (
+            errno.ECONNRESET, errno.EPIPE
+        )
+
+    @staticmethod
+    def _post(connection, path, data, timeout):
+        """
+        Send the request and return the response once its headers are read
+        """
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        try:
+            connection.request('POST', path, data, {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            })
+            return connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+
+    def _read(self, host, connection, response):
+        """
+        Return the body of the response and give back the connection
+        """
+        try:
+            body = response.read()
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(host, connection)
+        return body
+
+
+#: Process wide pool of connections to UPS
+connection_pool = ConnectionPool()
+
+
+class CircuitOpenError(socket.error):
+    """
+    Raised instead of calling UPS while the circuit of the call is open.
+    It is a network error, so callers fall back as if UPS was unreachable.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling an endpoint of UPS after repeated failures.
+
+    After `threshold` consecutive failures the circuit opens and every
+    call fails fast with CircuitOpenError, so an outage does not tie up
+    the workers waiting for timeouts. Once `reset_timeout` seconds have
+    passed, a single call is let through: its success closes the circuit
+    and its failure opens it again.
+    """
+
+    def __init__(
+            self, threshold=CIRCUIT_THRESHOLD,
+            reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if self._probing \
+                    or time.time() - self.opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if the call must not be made
+
+        :return: True if the call is the probe of a half-open circuit
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if not self._probing \
+                    and time.time() - self.opened_at >= self.reset_timeout:
+                self._probing = True
+                return True
+        raise CircuitOpenError('UPS is unavailable, retry later.')
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.opened_at = time.time()
+            self._probing = False
+
+    def release(self):
+        """
+        Let another call probe the circuit, the probe having failed without
+        telling whether UPS is back
+        """
+        with self._lock:
+            self._probing = False
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = Lock()
+
+
+def get_circuit_breaker(url):
+    """
+    Return the circuit breaker of the UPS endpoint
+    """
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(url)
+        if breaker is None:
+            breaker = _circuit_breakers[url] = CircuitBreaker()
+    return breaker
+
+
+def is_outage(error):
+    """
+    Return True if the error tells that UPS is failing rather than the
+    request
+    """
+    if isinstance(error, PyUPSException):
+        # UPS tells which errors are worth a retry by their severity
+        return unicode(error[0]).startswith('Transient')
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    return True
+
+
+def is_retryable(error, call):
+    """
+    Return True if the request of the call type which failed with the
+    error can safely be sent again
+    """
+    if not is_outage(error):
+        return False
+    return isinstance(error, PyUPSException) or call not in NOT_IDEMPOTENT
+
+
+def backoff(attempt):
+    """
+    Return the seconds to wait before the attempt following the given one,
+    exponential and fully jittered so that the workers do not retry in
+    lockstep
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def call_with_retry(call, url, function, *args):
+    """
+    Return the result of function called with args, which sends a request
+    of the call type to the url.
+
+    Transient failures are retried with backoff, and the circuit breaker
+    of the url fails the call fast when UPS keeps failing. Every failed
+    attempt is counted in the metrics, but the circuit breaker counts a
+    single failure per call, once its retries are exhausted, so its
+    threshold is a number of failed calls.
+    """
+    breaker = get_circuit_breaker(url)
+    retries = RETRIES.get(call, 0)
+    attempt = 0
+    while True:
+        try:
+            probe = breaker.before_call()
+        except CircuitOpenError, e:
+            metrics.error(call, e)
+            raise
+        try:
+            result = function(*args)
+        except (PyUPSException,) + NETWORK_ERRORS, e:
+            metrics.error(call, e)
+            if not is_outage(e):
+                # UPS answered, the request was at fault
+                breaker.success()
+                raise
+            if probe or attempt >= retries or not is_retryable(e, call):
+                # A failed probe opens the circuit again without retrying
+                breaker.failure()
+                raise
+            time.sleep(backoff(attempt))
+            attempt += 1
+        except Exception:
+            # Neither a success nor a failure of UPS, but it must not leave
+            # the circuit waiting for the probe
+            if probe:
+                breaker.release()
+            raise
+        else:
+            breaker.success()
+            return result
+
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket letting `rate` requests per second through,
+    with bursts of up to one second of requests.
+
+    Batch requests only take tokens above the reserved part of the bucket,
+    so when batch work keeps the bucket low the interactive requests still
+    find tokens waiting for them.
+    """
+
+    def __init__(self, rate, reserve=BATCH_RESERVE):
+        assert rate > 0
+        self.rate = float(rate)
+        self.capacity = max(2.0, self.rate)
+        self.reserve = reserve
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = Lock()
+
+    def take(self, batch=False):
+        """
+        Take a token and return 0, or return the seconds to wait before
+        one is available
+        """
+        needed = 1 + (self.capacity * self.reserve if batch else 0)
+        with self._lock:
+            now = time.time()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= needed:
+                self.tokens -= 1
+                return 0
+            return (needed - self.tokens) / self.rate
+
+    def acquire(self, batch=False):
+        """
+        Wait until a request can be sent
+        """
+        wait = self.take(batch)
+        while wait:
+            time.sleep(wait)
+            wait = self.take(batch)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A token bucket kept outside of the process, so that the requests of
+    all the server processes are limited together. The tokens are taken by
+    `take_shared`, called with the rate, the capacity of the bucket, the
+    tokens needed and the tokens wanted, which returns a tuple of the
+    tokens granted and of the seconds to wait if none is.
+
+    Each call of `take_shared` locks the shared bucket, so the process
+    takes up to `SHARED_RESERVATION` seconds of requests at once and
+    spends them before taking more. The processes then lock the bucket a
+    few times per second at most whatever their requests, and a burst may
+    exceed the capacity of the bucket by the tokens they hold.
+    """
+
+    def __init__(self, rate, take_shared, reserve=BATCH_RESERVE):
+        super(SharedTokenBucket, self).__init__(rate, reserve)
+        self.take_shared = take_shared
+        self.tokens = 0
+        self.wanted = max(1, int(self.rate * SHARED_RESERVATION))
+
+    def take(self, batch=False):
+        needed = 1 + (self.capacity * self.reserve if batch else 0)
+        with self._lock:
+            if not self.tokens:
+                granted, wait = self.take_shared(
+                    self.rate, self.capacity, needed, self.wanted
+                )
+                if not granted:
+                    return wait
+                self.tokens = granted
+            self.tokens -= 1
+            return 0
+
+
+_local = local()
+
+
+@contextmanager
+def batch_priority(batch=True):
+    """
+    Send the requests of the thread, and of the threads of `request_many`
+    it starts, with the priority of batch work
+    """
+    previous = getattr(_local, 'batch', False)
+    _local.batch = batch
+    try:
+        yield
+    finally:
+        _local.batch = previous
+
+
+@contextmanager
+def capture_into(captures):
+    """
+    Append a dictionary for each request sent by the thread to the list
+    captures, with the keys call, request, response, latency and error.
+    Nothing is captured if captures is None.
+    """
+    previous = getattr(_local, 'captures', None)
+    _local.captures = captures
+    try:
+        yield
+    finally:
+        _local.captures = previous
+
+
+class RateLimiter(object):
+    """
+    The token buckets limiting the requests sent by the process to UPS,
+    by call type and account
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = Lock()
+
+    def configure(self, call, account, rate, take_shared=None):
+        """
+        Limit the requests of the call type for the account to rate per
+        second, or remove the limit if rate is 0 or None
+
+        :param take_shared: The function taking the tokens of a
+                            `SharedTokenBucket` to share the limit with
+                            the other processes, or None to keep the
+                            bucket in the process
+        """
+        key = (call, account)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if not rate:
+                self._buckets.pop(key, None)
+            elif take_shared is not None:
+                if not isinstance(bucket, SharedTokenBucket) \
+                        or bucket.rate != rate:
+                    self._buckets[key] = SharedTokenBucket(rate, take_shared)
+            elif type(bucket) is not TokenBucket or bucket.rate != rate:
+                self._buckets[key] = TokenBucket(rate)
+
+    def acquire(self, call, account):
+        """
+        Wait until a request of the call type for the account can be sent
+        """
+        bucket = self._buckets.get((call, account))
+        if bucket is not None:
+            bucket.acquire(getattr(_local, 'batch', False))
+
+
+#: Process wide limits of the requests to UPS
+rate_limiter = RateLimiter()
+
+
+class KeepAliveMixin(object):
+    """
+    Send the requests of an API client through the connection pool, with
+    the timeout of its call type and retries
+    """
+
+    #: Call type of the client as used by `get_client`
+    call = None
+
+    #: Function returning the values used by the module out of the raw
+    #: response, see `request_parsed`
+    parse_response = None
+
+    def send_request(self, url, data):
+        rate_limiter.acquire(self.call, self.license_no)
+        data = data.encode("utf-8")
+        start = time.time()
+        body = connection_pool.post(
+            url, data, timeout=TIMEOUTS.get(self.call)
+        )
+        metrics.observe(self.call, time.time() - start, len(data), len(body))
+        return body
+
+    def request(self, request):
+        return call_with_retry(
+            self.call, self.url, super(KeepAliveMixin, self).request,
+            request
+        )
+
+    def request_parsed(self, request):
+        """
+        Send the request like `request` does, but return only the values
+        extracted by `parse_response` from the raw response instead of the
+        whole objectified response
+        """
+        full_request = '\n'.join([
+            '<?xml version="1.0" encoding="UTF-8" ?>',
+            etree.tostring(self.access_request, pretty_print=True),
+            '<?xml version="1.0" encoding="UTF-8" ?>',
+            etree.tostring(request, pretty_print=True),
+        ])
+        self.logger.debug("Request XML: %s", full_request)
+
+        response = call_with_retry(
+            self.call, self.url, self._send_parsed, full_request
+        )
+
+        if self.return_xml:
+            return full_request, response
+        return response
+
+    def _send_parsed(self, full_request):
+        captures = getattr(_local, 'captures', None)
+        if captures is None:
+            result = self.send_request(self.url, full_request)
+            with phase('parse'):
+                return self.parse_response(result, full_request)
+
+        start = time.time()
+        result = error = None
+        try:
+            result = self.send_request(self.url, full_request)
+            with phase('parse'):
+                return self.parse_response(result, full_request)
+        except PyUPSException, e:
+            error = unicode(e[0])
+            raise
+        except NETWORK_ERRORS, e:
+            error = unicode(e)
+            raise
+        finally:
+            captures.append({
+                'call': self.call,
+                'request': full_request,
+                'response': result,
+                'latency': time.time() - start,
+                'error': error,
+            })
+
+
+class KeepAliveShipmentConfirm(KeepAliveMixin, ShipmentConfirm):
+    call = 'confirm'
+    parse_response = staticmethod(parse_shipment_response)
+
+
+class KeepAliveShipmentAccept(KeepAliveMixin, ShipmentAccept):
+    call = 'accept'
+    parse_response = staticmethod(parse_shipment_response)
+
+
+class KeepAliveShipmentVoid(KeepAliveMixin, ShipmentVoid):
+    call = 'void'
+
+
+class KeepAliveRatingService(KeepAliveMixin, RatingService):
+    call = 'rate'
+    parse_response = staticmethod(parse_rate_response)
+
+
+CLIENTS = {
+    'confirm': KeepAliveShipmentConfirm,
+    'accept': KeepAliveShipmentAccept,
+    'void': KeepAliveShipmentVoid,
+    'rate': KeepAliveRatingService,
+}
+_clients = {}
+_clients_lock = Lock()
+
+
+def get_client(call, license_no, user_id, password, sandbox,
+               return_xml=False):
+    """
+    Return the long lived API client for the call type and credentials or
+    None if the call type is unknown. The clients hold no state of their
+    own between requests, so they are shared by all the threads.
+    """
+    if call not in CLIENTS:
+        return None
+    key = (
+        call, license_no, user_id, password, bool(sandbox), bool(return_xml)
+    )
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = CLIENTS[call](
+                license_no=license_no,
+                user_id=user_id,
+                password=password,
+                sandbox=sandbox,
+                return_xml=return_xml
+            )
+    return client
+
+
+class SingleFlight(object):
+    """
+    Coalesce identical calls made concurrently by several threads: the
+    first thread makes the call while the others wait for its outcome,
+    so a burst of identical requests costs a single call to UPS.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, function, *args):
+        """
+        Return the result of function called with args, or raise its
+        exception. If a call with the same key is in flight, wait for it
+        and share its outcome instead. Each thread gets its own copy of the
+        result.
+
+        :param key: Hashable key of the call, None to always make it
+        """
+        if key is None:
+            return function(*args)
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': Event()}
+
+        if not leader:
+            call['done'].wait()
+            if 'exc_info' in call:
+                exc_info = call['exc_info']
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return deepcopy(call['result'])
+
+        try:
+            call['result'] = function(*args)
+            return deepcopy(call['result'])
+        except BaseException:
+            call['exc_info'] = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+#: Process wide coalescing of the identical requests to UPS
+single_flight = SingleFlight()
+
+
+def _request(call):
+    """
+    Send a single request and return a tuple of the parsed response and
+    the PyUPSException or network error raised, if any
+    """
+    api, request, key, captures, batch = call
+    try:
+        with batch_priority(batch), capture_into(captures):
+            return single_flight.do(key, api.request_parsed, request), None
+    except (PyUPSException,) + NETWORK_ERRORS, e:
+        return None, e
+
+
+def request_many(calls, workers=4):
+    """
+    Send the requests concurrently through a bounded pool of threads.
+
+    The threads only do network and XML parsing work, so callers must
+    build the requests and handle the responses in the thread of the
+    transaction as the ORM can not be used from the pool.
+
+    :param calls: A list of tuples of (api instance, request xml), of
+                  (api instance, request xml, key) where key identifies
+                  identical requests for `single_flight`, or of (api
+                  instance, request xml, key, captures) where captures is
+                  the list given to `capture_into` for the request. Without
+                  it, the captures of the calling thread are used.
+    :param workers: Maximum number of requests in flight, they keep the
+                    `batch_priority` of the calling thread
+    :return: A list of tuples of (response as returned by `request_parsed`,
+             error or None) in the same order as the calls, where error is
+             a PyUPSException or one of the NETWORK_ERRORS
+    """
+    batch = getattr(_local, 'batch', False)
+    captures = getattr(_local, 'captures', None)
+
+    def pad(call):
+        call = tuple(call)
+        if len(call) < 3:
+            call += (None,)
+        if len(call) < 4:
+            call += (captures,)
+        return call + (batch,)
+    calls = map(pad, calls)
+    if len(calls) <= 1 or workers <= 1:
+        return map(_request, calls)
+
+    pool = ThreadPool(min(workers, len(calls)))
+    try:
+        return pool.map(_request, calls)
+    finally:
+        pool.close()
+        pool.join()
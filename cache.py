@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    cache.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import datetime, timedelta
+from threading import Lock
+
+from sql.aggregate import Max
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.protocols.jsonrpc import JSONEncoder, object_hook
+from trytond.transaction import Transaction
+
+__all__ = ['TTLCache', 'rate_cache', 'RateCache']
+
+
+class TTLCache(object):
+    """
+    A thread safe LRU cache whose entries expire after a time to live.
+
+    Values are deep copied on the way in and out so that callers can never
+    mutate what is held in the cache.
+    """
+
+    def __init__(self, size_limit=1024):
+        assert size_limit > 0
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for key if it has not expired yet
+        """
+        with self._lock:
+            try:
+                expire, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expire < time.time():
+                # Expired entries are kept for `get_stale` until evicted
+                self.misses += 1
+                return default
+            # Re-insert to mark the key as the most recently used one
+            del self._data[key]
+            self._data[key] = (expire, value)
+            self.hits += 1
+        return deepcopy(value)
+
+    def get_stale(self, key, default=None):
+        """
+        Return the value stored for key even if it has expired, as long as
+        it has not been evicted yet
+        """
+        with self._lock:
+            try:
+                _, value = self._data[key]
+            except KeyError:
+                return default
+        return deepcopy(value)
+
+    def set(self, key, value, ttl):
+        """
+        Store value for key during ttl seconds
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, deepcopy(value))
+            self._check_size_limit()
+        return value
+
+    def resize(self, size_limit):
+        """
+        Change the maximum number of entries, evicting the least recently
+        used ones if needed
+        """
+        assert size_limit > 0
+        with self._lock:
+            self.size_limit = size_limit
+            self._check_size_limit()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Return a dictionary with the hit and miss counters and the size
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'size_limit': self.size_limit,
+            }
+
+    def _check_size_limit(self):
+        while len(self._data) > self.size_limit:
+            self._data.popitem(last=False)
+
+
+#: Process wide cache of parsed UPS rating responses keyed by the database
+#: name and the fingerprint of the rate request.
+rate_cache = TTLCache()
+
+
+class RateCache(ModelSQL, ModelView):
+    """
+    Parsed UPS rates shared by all the workers of a database.
+    """
+    __name__ = 'ups.rate.cache'
+
+    fingerprint = fields.Char(
+        'Fingerprint', required=True, select=True, readonly=True
+    )
+    value = fields.Text('Value', required=True, readonly=True)
+    expire = fields.DateTime(
+        'Expire', required=True, select=True, readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(RateCache, cls).__setup__()
+        cls._order.insert(0, ('expire', 'DESC'))
+
+    @classmethod
+    def get_rates(cls, fingerprint):
+        """
+        Return a tuple of the rates stored last for the fingerprint and the
+        number of seconds they are still valid, or None
+        """
+        now = datetime.utcnow()
+        entries = cls.search([
+            ('fingerprint', '=', fingerprint),
+            ('expire', '>', now),
+        ], limit=1, order=[('id', 'DESC')])
+        if not entries:
+            return None
+        entry, = entries
+        return (
+            json.loads(entry.value, object_hook=object_hook),
+            (entry.expire - now).total_seconds(),
+        )
+
+    @classmethod
+    def set_rates(cls, fingerprint, rates, ttl):
+        """
+        Store the rates for the fingerprint during ttl seconds
+
+        The entries are only ever inserted: updating the entry of the
+        fingerprint would lock it until the end of the quotation, and the
+        concurrent quotations of the same cart would wait for each other
+        and then fail to serialize. The most recent entry wins and the
+        others are deleted by `clean`.
+        """
+        cls.create([{
+            'fingerprint': fingerprint,
+            'value': json.dumps(rates, cls=JSONEncoder),
+            'expire': datetime.utcnow() + timedelta(seconds=ttl),
+        }])
+
+    @classmethod
+    def clean(cls):
+        """
+        Delete the expired entries and those replaced by a more recent one.
+        Meant to be called by cron.
+        """
+        cls.delete(cls.search([('expire', '<=', datetime.utcnow())]))
+
+        table = cls.__table__()
+        cursor = Transaction().cursor
+        cursor.execute(*table.select(table.id, where=~table.id.in_(
+            table.select(Max(table.id), group_by=table.fingerprint)
+        )))
+        cls.delete(cls.browse([id_ for id_, in cursor.fetchall()]))
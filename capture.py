@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+    capture.py
+
+    Keep a sample of the XML exchanged with UPS to debug the requests in
+    production without the full debug logging.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import random
+import re
+from contextlib import contextmanager
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+
+from .api import capture_into
+from .tools import autonomous_transaction
+
+__all__ = ['Capture', 'strip_xml']
+
+#: Elements whose text is not stored: the credentials and the images
+STRIPPED_ELEMENTS = (
+    'AccessLicenseNumber', 'UserId', 'Password', 'GraphicImage',
+    'HTMLImage', 'Image',
+)
+_stripped_re = re.compile(
+    r'(<(%s)>)[^<]*(</\2>)' % '|'.join(STRIPPED_ELEMENTS)
+)
+
+
+def strip_xml(xml):
+    """
+    Return the XML as unicode without the text of the STRIPPED_ELEMENTS
+    """
+    if xml is None:
+        return None
+    if not isinstance(xml, unicode):
+        xml = xml.decode('utf-8', 'replace')
+    return _stripped_re.sub(r'\1...\3', xml)
+
+
+class Capture(ModelSQL, ModelView):
+    """
+    Request sent to UPS and its response
+    """
+    __name__ = 'ups.capture'
+
+    call = fields.Selection([
+        ('rate', 'Rate'),
+        ('confirm', 'Confirm'),
+        ('accept', 'Accept'),
+        ('void', 'Void'),
+    ], 'Call', required=True, readonly=True, select=True)
+    resource = fields.Reference('Resource', selection=[
+        ('sale.sale', 'Sale'),
+        ('stock.shipment.out', 'Customer Shipment'),
+    ], readonly=True, select=True)
+    latency = fields.Float('Latency', readonly=True, help='In seconds.')
+    request = fields.Text('Request', readonly=True)
+    response = fields.Text('Response', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Capture, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._order.insert(1, ('id', 'DESC'))
+
+    @classmethod
+    def sample(cls):
+        """
+        Return a list to capture the requests of a record into if it is
+        part of the sample, else None
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        capture_rate = UPSConfiguration.get_snapshot().capture_rate
+        if capture_rate and random.random() < capture_rate:
+            return []
+        return None
+
+    @classmethod
+    @contextmanager
+    def capture(cls, record):
+        """
+        Capture the requests sent to UPS by the thread for the record, if
+        it is part of the sample
+        """
+        captures = cls.sample()
+        with capture_into(captures):
+            try:
+                yield
+            finally:
+                cls.store([(record, captures)])
+
+    @classmethod
+    def store(cls, records_captures):
+        """
+        Store the captured requests. They are committed apart from the
+        current transaction, as the captures of the failed calls are those
+        needed when their error rolls the transaction back. The oldest ones
+        are deleted by `clean`.
+
+        :param records_captures: A list of tuples of (record, captures)
+                                 where captures is a list filled by
+                                 `capture_into` or None
+        """
+        vlist = []
+        for record, captures in records_captures:
+            for capture in captures or []:
+                vlist.append({
+                    'call': capture['call'],
+                    'resource': '%s,%s' % (record.__name__, record.id),
+                    'latency': capture['latency'],
+                    'request': strip_xml(capture['request']),
+                    'response': strip_xml(capture['response']),
+                    'error': capture['error'],
+                })
+        if not vlist:
+            return
+        with autonomous_transaction():
+            cls.create(vlist)
+
+    @classmethod
+    def clean(cls):
+        """
+        Delete the oldest captures beyond the size of the buffer. Meant to
+        be called by cron.
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        capture_size = UPSConfiguration.get_snapshot().capture_size
+        if not capture_size:
+            return
+        oldest = cls.search(
+            [], offset=capture_size, limit=1, order=[('id', 'DESC')]
+        )
+        if oldest:
+            cls.delete(cls.search([('id', '<=', oldest[0].id)]))
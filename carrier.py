@@ -7,6 +7,7 @@
 """
 from decimal import Decimal
 
+from trytond.cache import Cache
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
@@ -43,6 +44,23 @@ class Carrier:
 
         return []
 
+    @classmethod
+    def get_rates_many(cls, sales):
+        """
+        Return a dictionary of the rates as returned by `get_rates` of the
+        carrier of each sale for each sale id. The sales of UPS carriers
+        are rated together, which is much faster than calling `get_rates`
+        in the context of each sale, and the other sales get no rates.
+        """
+        Sale = Pool().get('sale.sale')
+
+        rates = dict((sale.id, []) for sale in sales)
+        rates.update(Sale.get_ups_shipping_rates_many([
+            sale for sale in sales
+            if sale.carrier and sale.carrier.carrier_cost_method == 'ups'
+        ]))
+        return rates
+
     def get_sale_price(self):
         """Estimates the shipment rate for the current shipment
 
@@ -82,6 +100,42 @@ class UPSService(ModelSQL, ModelView):
     name = fields.Char('Name', required=True, select=True)
     code = fields.Char('Service Code', required=True, select=True)
 
+    _services_by_code_cache = Cache(
+        'ups.service.by_code', size_limit=1, context=False
+    )
+
     @staticmethod
     def default_active():
         return True
+
+    @classmethod
+    def create(cls, vlist):
+        cls._services_by_code_cache.clear()
+        return super(UPSService, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._services_by_code_cache.clear()
+        super(UPSService, cls).write(*args)
+
+    @classmethod
+    def delete(cls, services):
+        cls._services_by_code_cache.clear()
+        super(UPSService, cls).delete(services)
+
+    @classmethod
+    def get_services_by_code(cls):
+        """
+        Return a dictionary of the tuple of (id, name) of the active service
+        for each UPS service code. If several services share a code, the
+        first one found wins like the search by code used to.
+        """
+        services = cls._services_by_code_cache.get(None)
+        if services is not None:
+            return services
+
+        services = {}
+        for service in cls.search([]):
+            services.setdefault(service.code, (service.id, service.name))
+        cls._services_by_code_cache.set(None, services)
+        return services
@@ -5,12 +5,60 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+from trytond.cache import Cache
 from trytond.model import fields, ModelSingleton, ModelSQL, ModelView
 from trytond.pool import Pool
-from ups.shipping_package import ShipmentConfirm, ShipmentAccept, ShipmentVoid
-from ups.rating_package import RatingService
+from trytond.rpc import RPC
 
-__all__ = ['UPSConfiguration']
+from .api import get_client, rate_limiter
+from .metrics import metrics
+
+__all__ = ['UPSConfiguration', 'UPSConfigurationSnapshot']
+
+
+class UPSConfigurationSnapshot(object):
+    """
+    Read only copy of the values of the UPS configuration. Many2One values
+    are stored as ids.
+    """
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('UPS configuration snapshot is read only')
+
+    def api_instance(self, call='confirm', return_xml=False):
+        """Return Instance of UPS
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+        RateLimit = Pool().get('ups.rate.limit')
+
+        if not all([
+            self.license_key,
+            self.user_id,
+            self.password,
+            self.uom_system,
+        ]):
+            UPSConfiguration.raise_user_error('ups_credentials_required')
+
+        # The account wide limit is shared by all the server processes
+        rate_limiter.configure(
+            call, self.license_key,
+            getattr(self, 'rate_limit_%s' % call, None),
+            RateLimit.get_take(call, self.license_key)
+        )
+
+        # The clients are kept for the life of the process so that their
+        # requests reuse the keep-alive connections to UPS
+        return get_client(
+            call,
+            license_no=self.license_key,
+            user_id=self.user_id,
+            password=self.password,
+            sandbox=self.is_test,
+            return_xml=return_xml
+        )
 
 
 class UPSConfiguration(ModelSingleton, ModelSQL, ModelView):
@@ -18,6 +66,9 @@ class UPSConfiguration(ModelSingleton, ModelSQL, ModelView):
     Configuration settings for UPS.
     """
     __name__ = 'ups.configuration'
+    _snapshot_cache = Cache(
+        'ups.configuration.snapshot', size_limit=1, context=False
+    )
 
     license_key = fields.Char('UPS License Key', required=True)
     user_id = fields.Char('UPS User Id', required=True)
@@ -40,11 +91,86 @@ class UPSConfiguration(ModelSingleton, ModelSQL, ModelView):
         fields.Many2One('product.uom', 'Length UOM'),
         'get_default_uom'
     )
+    rate_cache_ttl = fields.Integer(
+        'Rate Cache TTL', help='Number of seconds a rate returned by UPS is '
+        'reused for identical requests. Zero disables the cache.'
+    )
+    rate_cache_size = fields.Integer(
+        'Rate Cache Size', help='Maximum number of rates kept in the cache.'
+    )
+    shared_rate_cache = fields.Boolean(
+        'Shared Rate Cache', help='Also store the rates in the database so '
+        'that they are reused by all the workers.'
+    )
+    rate_estimate = fields.Selection([
+        (None, 'Never'),
+        ('fallback', 'When UPS Is Unavailable'),
+        ('always', 'Instead Of UPS'),
+    ], 'Estimate Rates', help='Estimate the rates from the UPS rate charts '
+        'instead of calling UPS, or only when UPS can not be reached.')
+    rating_workers = fields.Integer(
+        'Rating Workers', help='Maximum number of requests sent '
+        'concurrently when several sales are quoted or the labels of '
+        'several shipments are made at once.'
+    )
+    rate_in_background = fields.Boolean(
+        'Rate Quotations In Background', help='Quoting a sale only queues '
+        'its rating, the shipping line is added shortly after by a '
+        'scheduled task.'
+    )
+    rate_limit_rate = fields.Float(
+        'Rate Requests Per Second', help='Maximum number of rate requests '
+        'sent to UPS per second by all the servers, empty for no limit.'
+    )
+    rate_limit_confirm = fields.Float(
+        'Confirm Requests Per Second', help='Maximum number of shipment '
+        'confirm requests sent to UPS per second by all the servers, empty '
+        'for no limit.'
+    )
+    rate_limit_accept = fields.Float(
+        'Accept Requests Per Second', help='Maximum number of shipment '
+        'accept requests sent to UPS per second by all the servers, empty '
+        'for no limit.'
+    )
+    rate_limit_void = fields.Float(
+        'Void Requests Per Second', help='Maximum number of shipment void '
+        'requests sent to UPS per second by all the servers, empty for no '
+        'limit.'
+    )
+    capture_rate = fields.Float(
+        'Capture Sample Rate', help='Share of the sales and shipments whose '
+        'requests to UPS are captured, from 0 for none to 1 for all.'
+    )
+    capture_size = fields.Integer(
+        'Captured Requests', help='Number of captured requests kept, the '
+        'oldest are deleted first.'
+    )
+    profile_calls = fields.Boolean(
+        'Profile Rating And Labels', help='Log the time and SQL queries '
+        'spent reading, building the requests, waiting for UPS, parsing '
+        'and writing each time a sale is rated or a label is made.'
+    )
 
     @staticmethod
     def default_uom_system():
         return '01'
 
+    @staticmethod
+    def default_rate_cache_ttl():
+        return 300
+
+    @staticmethod
+    def default_rate_cache_size():
+        return 1024
+
+    @staticmethod
+    def default_rating_workers():
+        return 4
+
+    @staticmethod
+    def default_capture_size():
+        return 100
+
     def get_default_uom(self, name):
         """
         Return default UOM on basis of uom_system
@@ -90,34 +216,84 @@ class UPSConfiguration(ModelSingleton, ModelSQL, ModelView):
             'ups_credentials_required':
                 'UPS settings on UPS configuration are incomplete.',
         })
+        cls._sql_constraints += [
+            ('rate_cache_ttl_positive', 'CHECK(rate_cache_ttl >= 0)',
+                'Rate Cache TTL must be positive.'),
+            ('rate_cache_size_positive', 'CHECK(rate_cache_size > 0)',
+                'Rate Cache Size must be greater than zero.'),
+            ('rate_limit_rate_positive', 'CHECK(rate_limit_rate >= 0)',
+                'Rate Requests Per Second must be positive.'),
+            ('rate_limit_confirm_positive', 'CHECK(rate_limit_confirm >= 0)',
+                'Confirm Requests Per Second must be positive.'),
+            ('rate_limit_accept_positive', 'CHECK(rate_limit_accept >= 0)',
+                'Accept Requests Per Second must be positive.'),
+            ('rate_limit_void_positive', 'CHECK(rate_limit_void >= 0)',
+                'Void Requests Per Second must be positive.'),
+            ('capture_rate_range',
+                'CHECK(capture_rate >= 0 AND capture_rate <= 1)',
+                'Capture Sample Rate must be between 0 and 1.'),
+            ('capture_size_positive', 'CHECK(capture_size > 0)',
+                'Captured Requests must be greater than zero.'),
+        ]
+        cls.__rpc__.update({
+            'get_metrics': RPC(),
+            'dump_metrics': RPC(),
+        })
+
+    @classmethod
+    def create(cls, vlist):
+        cls._snapshot_cache.clear()
+        return super(UPSConfiguration, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._snapshot_cache.clear()
+        super(UPSConfiguration, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        cls._snapshot_cache.clear()
+        super(UPSConfiguration, cls).delete(records)
+
+    @classmethod
+    def get_snapshot(cls):
+        """
+        Return the UPSConfigurationSnapshot of the configuration. It is
+        built once and kept until the configuration is modified, so the
+        callers do not read the configuration and resolve its UOMs again.
+        """
+        snapshot = cls._snapshot_cache.get(None)
+        if snapshot is not None:
+            return snapshot
+
+        config = cls(1)
+        values = {}
+        for name, field in cls._fields.iteritems():
+            value = getattr(config, name)
+            if field._type == 'many2one':
+                value = value.id if value else None
+            values[name] = value
+        snapshot = UPSConfigurationSnapshot(values)
+        cls._snapshot_cache.set(None, snapshot)
+        return snapshot
 
     def api_instance(self, call='confirm', return_xml=False):
         """Return Instance of UPS
         """
-        if not all([
-            self.license_key,
-            self.user_id,
-            self.password,
-            self.uom_system,
-        ]):
-            self.raise_user_error('ups_credentials_required')
-
-        if call == 'confirm':
-            call_method = ShipmentConfirm
-        elif call == 'accept':
-            call_method = ShipmentAccept
-        elif call == 'void':
-            call_method = ShipmentVoid
-        elif call == 'rate':
-            call_method = RatingService
-        else:
-            call_method = None
-
-        if call_method:
-            return call_method(
-                license_no=self.license_key,
-                user_id=self.user_id,
-                password=self.password,
-                sandbox=self.is_test,
-                return_xml=return_xml
-            )
+        return self.get_snapshot().api_instance(call, return_xml)
+
+    @classmethod
+    def get_metrics(cls):
+        """
+        Return the metrics of the requests sent to UPS by this process, as
+        a dictionary by call type
+        """
+        return metrics.stats()
+
+    @classmethod
+    def dump_metrics(cls):
+        """
+        Return the metrics of the requests sent to UPS by this process as
+        text in the Prometheus exposition format
+        """
+        return metrics.dump()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+    currency.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.cache import Cache
+from trytond.pool import PoolMeta
+
+__all__ = ['Currency']
+__metaclass__ = PoolMeta
+
+
+class Currency:
+    "Currency"
+    __name__ = 'currency.currency'
+
+    _ids_by_code_cache = Cache(
+        'currency.currency.ids_by_code', size_limit=1, context=False
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        cls._ids_by_code_cache.clear()
+        return super(Currency, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._ids_by_code_cache.clear()
+        super(Currency, cls).write(*args)
+
+    @classmethod
+    def delete(cls, currencies):
+        cls._ids_by_code_cache.clear()
+        super(Currency, cls).delete(currencies)
+
+    @classmethod
+    def get_ids_by_code(cls):
+        """
+        Return a dictionary of the id of the active currency for each ISO
+        code
+        """
+        ids = cls._ids_by_code_cache.get(None)
+        if ids is not None:
+            return ids
+
+        ids = dict((c.code, c.id) for c in cls.search([]))
+        cls._ids_by_code_cache.set(None, ids)
+        return ids
+
+    @classmethod
+    def get_by_code(cls, code):
+        """
+        Return the active currency of the ISO code as sent by UPS
+        """
+        return cls(cls.get_ids_by_code()[str(code)])
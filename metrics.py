@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics.py
+
+    Instrumentation of the requests sent to UPS.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from copy import deepcopy
+from threading import Lock
+
+from ups.base import PyUPSException
+
+__all__ = ['CallMetrics', 'metrics', 'error_code']
+
+#: Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def error_code(error):
+    """
+    Return the UPS error code of a PyUPSException, whose message is
+    "severity-code:description", or the name of the class of other errors
+    """
+    if isinstance(error, PyUPSException):
+        head = unicode(error[0]).split(':', 1)[0]
+        return head.split('-', 1)[-1]
+    return error.__class__.__name__
+
+
+class CallMetrics(object):
+    """
+    Thread safe counters of the requests sent to UPS by call type: a
+    histogram of the time spent waiting for UPS, the sizes of the
+    requests and responses and the errors by code.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        self._calls = {}
+
+    def _get_call(self, call):
+        values = self._calls.get(call)
+        if values is None:
+            values = self._calls[call] = {
+                'count': 0,
+                'latency_buckets': [0] * (len(self.buckets) + 1),
+                'latency_sum': 0.0,
+                'latency_max': 0.0,
+                'request_bytes': 0,
+                'response_bytes': 0,
+                'response_bytes_max': 0,
+                'errors': {},
+            }
+        return values
+
+    def observe(self, call, latency, request_bytes, response_bytes):
+        """
+        Record a request answered by UPS
+        """
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if latency <= bound:
+                index = i
+                break
+        with self._lock:
+            values = self._get_call(call)
+            values['count'] += 1
+            values['latency_buckets'][index] += 1
+            values['latency_sum'] += latency
+            values['latency_max'] = max(values['latency_max'], latency)
+            values['request_bytes'] += request_bytes
+            values['response_bytes'] += response_bytes
+            values['response_bytes_max'] = max(
+                values['response_bytes_max'], response_bytes
+            )
+
+    def error(self, call, error):
+        """
+        Record a request which failed with the error
+        """
+        code = error_code(error)
+        with self._lock:
+            errors = self._get_call(call)['errors']
+            errors[code] = errors.get(code, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+
+    def stats(self):
+        """
+        Return a dictionary of the counters of each call type. The latency
+        buckets are a list of (upper bound, count) where the last bound is
+        None for the requests slower than all the others.
+        """
+        with self._lock:
+            calls = deepcopy(self._calls)
+        for values in calls.itervalues():
+            values['latency_buckets'] = zip(
+                self.buckets + (None,), values['latency_buckets']
+            )
+        return calls
+
+    def dump(self):
+        """
+        Return the counters as text in the Prometheus exposition format
+        """
+        lines = []
+        for call, values in sorted(self.stats().iteritems()):
+            label = 'call="%s"' % call
+            total = 0
+            for bound, count in values['latency_buckets']:
+                total += count
+                lines.append('ups_request_seconds_bucket{%s,le="%s"} %d' % (
+                    label, '+Inf' if bound is None else bound, total
+                ))
+            lines.extend([
+                'ups_request_seconds_sum{%s} %f' % (
+                    label, values['latency_sum']),
+                'ups_request_seconds_count{%s} %d' % (
+                    label, values['count']),
+                'ups_request_seconds_max{%s} %f' % (
+                    label, values['latency_max']),
+                'ups_request_bytes_sum{%s} %d' % (
+                    label, values['request_bytes']),
+                'ups_response_bytes_sum{%s} %d' % (
+                    label, values['response_bytes']),
+                'ups_response_bytes_max{%s} %d' % (
+                    label, values['response_bytes_max']),
+            ])
+            for code, count in sorted(values['errors'].iteritems()):
+                lines.append('ups_errors_total{%s,code="%s"} %d' % (
+                    label, code, count
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+#: Process wide metrics of the requests to UPS
+metrics = CallMetrics()
@@ -6,8 +6,10 @@
     :license: BSD, see LICENSE for more details.
 """
 import re
+from copy import deepcopy
 
 from ups.shipping_package import ShipmentConfirm
+from trytond.cache import Cache
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 
@@ -23,6 +25,8 @@ class Address:
     '''
     __name__ = "party.address"
 
+    _ups_xml_cache = Cache('party.address.ups_xml', context=False)
+
     @classmethod
     def __setup__(cls):
         super(Address, cls).__setup__()
@@ -31,10 +35,53 @@ class Address:
                 '%s is missing in %s.'
         })
 
+    def _get_ups_revision(self):
+        """
+        Return the revision of the records the UPS XML of the address is
+        built from: the address, its party and contact mechanisms, its
+        country and subdivision and the party of the company
+        """
+        Company = Pool().get('company.company')
+
+        def revision(record):
+            return record and (record.id, record.write_date)
+
+        company_id = Transaction().context.get('company')
+        company_party = company_id and Company(company_id).party
+        return (
+            revision(self), revision(self.party),
+            tuple(map(revision, self.party.contact_mechanisms)),
+            revision(self.country), revision(self.subdivision),
+            revision(company_party),
+        )
+
+    def _get_ups_cached_xml(self, name, build, *key):
+        """
+        Return a copy of the XML element returned by build, which is kept
+        in a cache for the revision of the records it is built from, so a
+        change of any of them builds it again. The elements are copied
+        because lxml moves an element when it is added to a request.
+
+        :param name: Name of the element in the cache
+        :param build: Method which builds the element
+        :param key: Other values the element depends on
+        """
+        key = (name, self._get_ups_revision()) + key
+        element = self._ups_xml_cache.get(key)
+        if element is None:
+            element = self._ups_xml_cache.set(key, build())
+        return deepcopy(element)
+
     def _get_ups_address_xml(self):
         """
         Return Address XML
         """
+        return self._get_ups_cached_xml('address', self._make_ups_address_xml)
+
+    def _make_ups_address_xml(self):
+        """
+        Build Address XML
+        """
         if not all([self.street, self.city, self.country]):
             self.raise_user_error("Street, City and Country are required.")
 
@@ -75,6 +122,14 @@ class Address:
 
         :return: Returns instance of FromAddress
         '''
+        return self._get_ups_cached_xml(
+            'from_address', self._make_ups_from_address
+        )
+
+    def _make_ups_from_address(self):
+        '''
+        Build the UPS `From Address` of the party address.
+        '''
         Company = Pool().get('company.company')
 
         vals = {}
@@ -118,6 +173,14 @@ class Address:
 
         :return: Returns instance of ToAddress
         '''
+        return self._get_ups_cached_xml(
+            'to_address', self._make_ups_to_address
+        )
+
+    def _make_ups_to_address(self):
+        '''
+        Build the UPS `To Address` of the party address.
+        '''
         party = self.party
         if not party.phone:
             self.raise_user_error(
@@ -158,6 +221,17 @@ class Address:
 
         :return: Returns instance of ShipperAddress
         '''
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        return self._get_ups_cached_xml(
+            'shipper', self._make_ups_shipper,
+            UPSConfiguration.get_snapshot().shipper_no
+        )
+
+    def _make_ups_shipper(self):
+        '''
+        Build the UPS `Shipper Address` of the party address.
+        '''
         Company = Pool().get('company.company')
         UPSConfiguration = Pool().get('ups.configuration')
 
@@ -182,7 +256,7 @@ class Address:
             'Name': self.name and self.party.name,
             'AttentionName': self.name or self.party.name,
             'PhoneNumber': digits_only_re.sub('', self.party.phone),
-            'ShipperNumber': UPSConfiguration(1).shipper_no,
+            'ShipperNumber': UPSConfiguration.get_snapshot().shipper_no,
         }
 
         fax = self.party.fax
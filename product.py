@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+    product.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.cache import Cache
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['Uom']
+__metaclass__ = PoolMeta
+
+
+class Uom:
+    "Unit of measure"
+    __name__ = 'product.uom'
+
+    _conversion_factors_cache = Cache(
+        'product.uom.conversion_factors', size_limit=1, context=False
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        cls._conversion_factors_cache.clear()
+        return super(Uom, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._conversion_factors_cache.clear()
+        super(Uom, cls).write(*args)
+
+    @classmethod
+    def delete(cls, uoms):
+        cls._conversion_factors_cache.clear()
+        super(Uom, cls).delete(uoms)
+
+    @classmethod
+    def get_conversion_factors(cls):
+        """
+        Return a dictionary of the factor by which a quantity in a UOM is
+        multiplied to get it in another UOM of the same category and the
+        rounding of the latter, for all the pairs of UOMs by their ids
+        """
+        factors = cls._conversion_factors_cache.get(None)
+        if factors is not None:
+            return factors
+
+        with Transaction().set_context(active_test=False):
+            uoms = cls.search([])
+
+        # The value of one unit of each UOM in the reference UOM of its
+        # category, computed the way compute_qty does
+        categories = {}
+        for uom in uoms:
+            if uom.accurate_field == 'factor':
+                value = uom.factor
+            else:
+                value = 1 / uom.rate
+            categories.setdefault(uom.category.id, []).append((uom, value))
+
+        factors = {}
+        for category_uoms in categories.itervalues():
+            for from_uom, from_value in category_uoms:
+                for to_uom, to_value in category_uoms:
+                    if to_uom.accurate_field == 'factor':
+                        factor = from_value / to_uom.factor
+                    else:
+                        factor = from_value * to_uom.rate
+                    factors[(from_uom.id, to_uom.id)] = (
+                        factor, to_uom.rounding
+                    )
+        cls._conversion_factors_cache.set(None, factors)
+        return factors
+
+    @classmethod
+    def compute_qty_by_factor(cls, from_uom, qty, to_uom):
+        """
+        Convert quantity for given uom's like compute_qty but with the
+        cached conversion factors instead of reading the uom's
+        """
+        if not from_uom or not qty or not to_uom:
+            return qty
+        factors = cls.get_conversion_factors()
+        if (from_uom.id, to_uom.id) not in factors:
+            return cls.compute_qty(from_uom, qty, to_uom)
+        factor, rounding = factors[(from_uom.id, to_uom.id)]
+        return cls.round(qty * factor, rounding)
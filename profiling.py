@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+    profiling.py
+
+    Opt-in breakdown of the time and SQL queries spent rating and labelling
+    into the phases of the work: ORM reads, XML build, network wait,
+    response parsing and ORM writes.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from threading import local
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['Profile', 'phase', 'profiled']
+
+logger = logging.getLogger('trytond.modules.ups.profiling')
+
+#: Phases in the order of the report
+PHASES = ('read', 'build', 'network', 'parse', 'write', 'other')
+
+_local = local()
+
+
+class Profile(object):
+    """
+    Time and SQL queries spent in each phase of a call. The time of a
+    phase does not include the time of the phases nested in it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = OrderedDict((p, [0.0, 0]) for p in PHASES)
+        self.queries = 0
+        self._stack = ['other']
+        self._since = time.time()
+        self._since_queries = 0
+
+    def _switch(self):
+        """
+        Account the time and queries since the last switch to the current
+        phase
+        """
+        now = time.time()
+        values = self.phases.setdefault(self._stack[-1], [0.0, 0])
+        values[0] += now - self._since
+        values[1] += self.queries - self._since_queries
+        self._since = now
+        self._since_queries = self.queries
+
+    @contextmanager
+    def phase(self, name):
+        self._switch()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self._stack.pop()
+
+    @contextmanager
+    def count_queries(self, cursor):
+        """
+        Count the queries executed by the cursor
+        """
+        previous = cursor.__dict__.get('execute')
+        execute = cursor.execute
+
+        def counting_execute(*args, **kwargs):
+            self.queries += 1
+            return execute(*args, **kwargs)
+        cursor.execute = counting_execute
+        try:
+            yield
+        finally:
+            if previous is None:
+                del cursor.execute
+            else:
+                cursor.execute = previous
+
+    def report(self):
+        """
+        Return a line with the total and the time and queries of each phase
+        """
+        self._switch()
+        total = sum(t for t, _ in self.phases.itervalues())
+        parts = [
+            '%s %.1f ms %d queries' % (name, seconds * 1000, queries)
+            for name, (seconds, queries) in self.phases.iteritems()
+            if seconds or queries
+        ]
+        return '%s: %.1f ms %d queries (%s)' % (
+            self.name, total * 1000, self.queries, ', '.join(parts)
+        )
+
+
+@contextmanager
+def phase(name):
+    """
+    Account the time and queries of the block to the phase of the profile
+    of the thread, if any
+    """
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        yield
+    else:
+        with profile.phase(name):
+            yield
+
+
+def profiled(function):
+    """
+    Decorate a method to profile its calls when the profiling is enabled
+    in the UPS configuration. The calls it makes to other profiled methods
+    are part of its own profile.
+    """
+    @wraps(function)
+    def wrapper(self, *args, **kwargs):
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        if getattr(_local, 'profile', None) is not None \
+                or not UPSConfiguration.get_snapshot().profile_calls:
+            return function(self, *args, **kwargs)
+
+        profile = _local.profile = Profile('%s %s,%s' % (
+            function.__name__, self.__name__, self.id
+        ))
+        try:
+            with profile.count_queries(Transaction().cursor):
+                return function(self, *args, **kwargs)
+        finally:
+            _local.profile = None
+            logger.info(profile.report())
+    return wrapper
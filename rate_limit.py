@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+    rate_limit.py
+
+    Token buckets shared by all the server processes of a database.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from functools import partial
+
+from trytond import backend
+from trytond.config import CONFIG
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+
+__all__ = ['RateLimit']
+
+#: Seconds since the epoch by the clock of the database
+NOW = 'CAST(EXTRACT(EPOCH FROM clock_timestamp()) AS DOUBLE PRECISION)'
+
+
+class RateLimit(ModelSQL):
+    """
+    Token bucket of the requests of a call type for a UPS account, shared
+    by all the server processes
+    """
+    __name__ = 'ups.rate.limit'
+
+    name = fields.Char('Name', required=True, readonly=True)
+    tokens = fields.Float('Tokens', required=True, readonly=True)
+    updated = fields.Float(
+        'Updated', required=True, readonly=True,
+        help='Seconds since the epoch, from the clock of the database.'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(RateLimit, cls).__setup__()
+        cls._sql_constraints += [
+            ('name_uniq', 'UNIQUE(name)', 'The name must be unique.'),
+        ]
+
+    @classmethod
+    def get_take(cls, call, account):
+        """
+        Return the function taking the tokens of the call type for the
+        account, as expected by `SharedTokenBucket`, or None if the bucket
+        can not be shared.
+
+        The buckets are shared on PostgreSQL only, as they rely on its
+        clock, and stay in the process on the other databases.
+        """
+        if CONFIG['db_type'] != 'postgresql':
+            return None
+        return partial(
+            cls.take, Transaction().cursor.database_name,
+            '%s,%s' % (call, account)
+        )
+
+    @classmethod
+    def take(cls, database_name, name, rate, capacity, needed, wanted):
+        """
+        Take up to wanted tokens from the bucket and return a tuple of the
+        tokens taken and of 0, or return 0 and the seconds to wait before
+        enough tokens are available.
+
+        The bucket is locked and updated in a transaction of its own, like
+        `Cache.resets` does, as this is called by the threads sending the
+        requests outside of any transaction. The clock of the database is
+        used so the servers do not need synchronized clocks.
+        """
+        Database = backend.get('Database')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+
+        database = Database(database_name).connect()
+        cursor = database.cursor()
+        try:
+            row = cls._lock(cursor, name)
+            if row is None:
+                try:
+                    cursor.execute(
+                        'INSERT INTO "%s" (name, tokens, updated) '
+                        'VALUES (%%s, %%s, %s)' % (cls._table, NOW),
+                        (name, capacity)
+                    )
+                except DatabaseIntegrityError:
+                    # Another process created the bucket meanwhile
+                    cursor.rollback()
+                else:
+                    cursor.commit()
+                row = cls._lock(cursor, name)
+
+            tokens, updated, now = row
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= needed:
+                granted = min(wanted, int(tokens - needed) + 1)
+                tokens -= granted
+                wait = 0
+            else:
+                granted = 0
+                wait = (needed - tokens) / rate
+            cursor.execute(
+                'UPDATE "%s" SET tokens = %%s, updated = %%s '
+                'WHERE name = %%s' % cls._table, (tokens, now, name)
+            )
+            cursor.commit()
+        finally:
+            cursor.close()
+        return granted, wait
+
+    @classmethod
+    def _lock(cls, cursor, name):
+        """
+        Lock the bucket and return a tuple of its tokens, the time it was
+        updated and the current time, or None if it does not exist
+        """
+        cursor.execute(
+            'SELECT tokens, updated, %s FROM "%s" WHERE name = %%s '
+            'FOR UPDATE' % (NOW, cls._table), (name,)
+        )
+        return cursor.fetchone()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+    rate_table.py
+
+    Estimate the UPS rates offline from the published zone and rate charts.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from bisect import bisect_left, bisect_right
+
+from trytond.cache import Cache
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+
+__all__ = ['RateTable', 'RateZone', 'RateChart']
+
+
+def zip_prefix(zip_code):
+    """
+    Return the 3 digits prefix of a ZIP code used by the zone charts
+    """
+    digits = ''.join(c for c in (zip_code or '') if c.isdigit())
+    return digits[:3] if len(digits) >= 3 else None
+
+
+class RateTable(object):
+    """
+    In memory index of the zone and rate charts.
+
+    The zones of a service are grouped by range of origin prefixes, each
+    group holding the destination ranges sorted for a binary search. The
+    prices of a service and zone are sorted by maximum weight, so a lookup
+    is a couple of bisections.
+    """
+
+    def __init__(self, zones, prices):
+        """
+        :param zones: An iterable of tuples of (service code, origin from,
+                      origin to, destination from, destination to, zone)
+        :param prices: An iterable of tuples of (service code, zone,
+                       maximum weight, price, currency id)
+        """
+        self._zones = {}
+        for service, origin_from, origin_to, dest_from, dest_to, zone in \
+                sorted(zones, key=lambda z: (z[0], z[1], z[2], z[3])):
+            origins = self._zones.setdefault(service, [])
+            if not origins or origins[-1][:2] != (origin_from, origin_to):
+                origins.append((origin_from, origin_to, [], []))
+            origins[-1][2].append(dest_from)
+            origins[-1][3].append((dest_to, zone))
+
+        self._prices = {}
+        for service, zone, weight, price, currency in \
+                sorted(prices, key=lambda p: (p[0], p[1], p[2])):
+            weights, values = self._prices.setdefault(
+                (service, zone), ([], [])
+            )
+            weights.append(weight)
+            values.append((price, currency))
+
+    def services(self):
+        return sorted(self._zones)
+
+    def zone(self, service, origin_zip, destination_zip):
+        """
+        Return the zone of the service between the ZIP codes or None
+        """
+        origin, destination = zip_prefix(origin_zip), \
+            zip_prefix(destination_zip)
+        if not origin or not destination:
+            return None
+        for origin_from, origin_to, dest_froms, dest_tos in \
+                self._zones.get(service, []):
+            if not origin_from <= origin <= origin_to:
+                continue
+            index = bisect_right(dest_froms, destination) - 1
+            if index >= 0 and destination <= dest_tos[index][0]:
+                return dest_tos[index][1]
+        return None
+
+    def price(self, service, origin_zip, destination_zip, weight):
+        """
+        Return a tuple of the price and currency id to ship the weight with
+        the service between the ZIP codes, or None if the charts do not
+        cover it
+        """
+        zone = self.zone(service, origin_zip, destination_zip)
+        if zone is None:
+            return None
+        weights, values = self._prices.get((service, zone), ([], []))
+        index = bisect_left(weights, weight)
+        if index == len(weights):
+            return None
+        return values[index]
+
+
+class RateTableMixin(object):
+    """
+    Invalidate the rate table when the charts change
+    """
+    _rate_table_cache = Cache('ups.rate.table', size_limit=1, context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        cls._rate_table_cache.clear()
+        return super(RateTableMixin, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._rate_table_cache.clear()
+        super(RateTableMixin, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        cls._rate_table_cache.clear()
+        super(RateTableMixin, cls).delete(records)
+
+
+class RateZone(RateTableMixin, ModelSQL, ModelView):
+    "UPS Rate Zone"
+    __name__ = 'ups.rate.zone'
+
+    service = fields.Many2One(
+        'ups.service', 'Service', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    origin_from = fields.Char('Origin ZIP From', required=True, size=3)
+    origin_to = fields.Char('Origin ZIP To', required=True, size=3)
+    destination_from = fields.Char(
+        'Destination ZIP From', required=True, size=3
+    )
+    destination_to = fields.Char('Destination ZIP To', required=True, size=3)
+    zone = fields.Char('Zone', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(RateZone, cls).__setup__()
+        cls._order.insert(0, ('service', 'ASC'))
+        cls._order.insert(1, ('origin_from', 'ASC'))
+        cls._order.insert(2, ('destination_from', 'ASC'))
+
+    @classmethod
+    def get_rate_table(cls):
+        """
+        Return the RateTable built from the zone and rate charts
+        """
+        RateChart = Pool().get('ups.rate.chart')
+
+        rate_table = cls._rate_table_cache.get(None)
+        if rate_table is not None:
+            return rate_table
+
+        zones = [
+            (z.service.code, z.origin_from, z.origin_to, z.destination_from,
+                z.destination_to, z.zone)
+            for z in cls.search([])
+        ]
+        prices = [
+            (c.service.code, c.zone, c.weight, c.price, c.currency.id)
+            for c in RateChart.search([])
+        ]
+        rate_table = RateTable(zones, prices)
+        cls._rate_table_cache.set(None, rate_table)
+        return rate_table
+
+
+class RateChart(RateTableMixin, ModelSQL, ModelView):
+    "UPS Rate Chart"
+    __name__ = 'ups.rate.chart'
+
+    service = fields.Many2One(
+        'ups.service', 'Service', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    zone = fields.Char('Zone', required=True, select=True)
+    weight = fields.Float(
+        'Maximum Weight', required=True,
+        help='In the weight UOM of the UPS configuration.'
+    )
+    price = fields.Numeric('Price', digits=(16, 2), required=True)
+    currency = fields.Many2One('currency.currency', 'Currency', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(RateChart, cls).__setup__()
+        cls._order.insert(0, ('service', 'ASC'))
+        cls._order.insert(1, ('zone', 'ASC'))
+        cls._order.insert(2, ('weight', 'ASC'))
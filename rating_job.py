@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    rating_job.py
+
+    Rate the quotations in the background.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from itertools import groupby
+
+from trytond import backend
+from trytond.config import CONFIG
+from trytond.exceptions import UserError
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .api import batch_priority
+
+__all__ = ['RatingJob']
+
+
+class RatingJob(ModelSQL, ModelView):
+    """
+    Rating of a sale queued when it was quoted
+    """
+    __name__ = 'ups.rating.job'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancel', 'Canceled'),
+    ], 'State', required=True, select=True, readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(RatingJob, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    def enqueue(cls, sales):
+        """
+        Queue the rating of the sales which are not already queued
+        """
+        Sale = Pool().get('sale.sale')
+
+        queued = set(job.sale.id for job in cls.search([
+            ('sale', 'in', [s.id for s in sales]),
+            ('state', '=', 'pending'),
+        ]))
+        sales = [s for s in sales if s.id not in queued]
+        if not sales:
+            return
+        cls.create([{'sale': s.id} for s in sales])
+        Sale.write(sales, {'ups_rating_state': 'pending'})
+
+    @classmethod
+    def settle(cls, sales):
+        """
+        Mark done the pending jobs of the rated sales and cancel their
+        failed jobs, which the rating supersedes
+        """
+        jobs = cls.search([
+            ('sale', 'in', [s.id for s in sales]),
+            ('state', 'in', ['pending', 'failed']),
+        ])
+        to_write = []
+        for state, new_state in (('pending', 'done'), ('failed', 'cancel')):
+            settled = [j for j in jobs if j.state == state]
+            if settled:
+                to_write.extend([settled, {'state': new_state}])
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def process(cls, sales=None):
+        """
+        Rate the sales of the pending jobs, or only those of the given
+        sales, and write their shipping line. Meant to be called by cron.
+
+        The sales of a company are rated together, concurrently, and if
+        that fails one by one so that a sale UPS refuses does not hold back
+        the others. The jobs another transaction is processing are left to
+        it.
+        """
+        Sale = Pool().get('sale.sale')
+
+        domain = [('state', '=', 'pending')]
+        if sales is not None:
+            domain.append(('sale', 'in', [s.id for s in sales]))
+
+        # The jobs are processed as root because the record rules of the
+        # sales depend on the company of the user, which the cron user
+        # does not have. Unless a confirmation waits for them, they give
+        # way to the interactive requests to UPS.
+        with Transaction().set_user(0), batch_priority(sales is None):
+            jobs = cls._lock(cls.search(domain))
+
+            to_cancel = [j for j in jobs if j.sale.state != 'quotation']
+            if to_cancel:
+                cls.write(to_cancel, {'state': 'cancel'})
+                Sale.write(
+                    [j.sale for j in to_cancel], {'ups_rating_state': None}
+                )
+
+            jobs = [j for j in jobs if j.sale.state == 'quotation']
+
+            def keyfunc(job):
+                return job.sale.company.id
+            for company_id, company_jobs in groupby(
+                    sorted(jobs, key=keyfunc), keyfunc):
+                with Transaction().set_context(company=company_id):
+                    cls._process(list(company_jobs))
+
+    @classmethod
+    def _lock(cls, jobs):
+        """
+        Lock the jobs and return those which no other transaction has
+        locked or processed meanwhile.
+
+        Each job is locked on its own without waiting, so the jobs of a
+        cron run and of a confirmation are shared between them. SQLite
+        databases are served by a single process and are not locked.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        if CONFIG['db_type'] != 'postgresql':
+            return jobs
+        cursor = Transaction().cursor
+        locked = []
+        for job in jobs:
+            cursor.execute('SAVEPOINT ups_rating_job')
+            try:
+                cursor.execute(
+                    'SELECT id FROM "%s" WHERE id = %%s FOR UPDATE NOWAIT'
+                    % cls._table, (job.id,)
+                )
+            except DatabaseOperationalError:
+                cursor.execute('ROLLBACK TO SAVEPOINT ups_rating_job')
+            else:
+                cursor.execute('RELEASE SAVEPOINT ups_rating_job')
+                locked.append(job)
+        return locked
+
+    @classmethod
+    def _process(cls, jobs):
+        """
+        Rate the sales of the jobs of a company.
+
+        The rated sales settle their jobs with `Sale._set_ups_rated`, which
+        is also called for the sales without any shipping line to write.
+        """
+        Sale = Pool().get('sale.sale')
+
+        if len(jobs) > 1:
+            sales = [j.sale for j in jobs]
+            try:
+                Sale._apply_ups_shipping_many(sales)
+            except UserError:
+                pass
+            else:
+                Sale._set_ups_rated(Sale.browse(sales))
+                return
+
+        for job in jobs:
+            try:
+                Sale._apply_ups_shipping_many([job.sale])
+            except UserError, e:
+                cls.write([job], {'state': 'failed', 'error': e.message})
+                Sale.write([job.sale], {'ups_rating_state': 'failed'})
+            else:
+                Sale._set_ups_rated(Sale.browse([job.sale]))
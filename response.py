@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+    response.py
+
+    Lean parsers of the UPS responses.
+
+    The responses are parsed incrementally and only the few values used by
+    the module are kept, instead of objectifying the whole document. Every
+    element is freed as soon as it has been read, which matters for the
+    shipment responses carrying the labels as large base64 strings.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from io import BytesIO
+
+from lxml import etree
+from ups.base import PyUPSException
+
+__all__ = ['parse_rate_response', 'parse_shipment_response']
+
+
+def _iter_elements(body, tags):
+    """
+    Yield the elements of the body with one of the tags once they are
+    completely parsed, and free them with the siblings before them when
+    the caller is done with them
+    """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    for _, element in etree.iterparse(
+            BytesIO(body), events=('end',), tag=tags):
+        yield element
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def _check_error(element, request, body):
+    """
+    Raise the PyUPSException of an Error element as pyups does, unless it
+    is only a warning
+    """
+    severity = element.findtext('ErrorSeverity')
+    if severity != 'Warning':
+        raise PyUPSException("%s-%s:%s" % (
+            severity,
+            element.findtext('ErrorCode'),
+            element.findtext('ErrorDescription'),
+        ), request, body)
+
+
+def _number(text):
+    """
+    Return the text as an integer if it is one, like objectify would
+    """
+    if text and text.isdigit():
+        return int(text)
+    return text
+
+
+def parse_rate_response(body, request=None):
+    """
+    Return a list with a dictionary for each RatedShipment of a rating
+    response with the keys:
+
+        ServiceCode, CurrencyCode, TotalCharges and, when UPS sent them,
+        NegotiatedCharges, ScheduledDeliveryTime, GuaranteedDaysToDelivery
+
+    All the values are strings except GuaranteedDaysToDelivery.
+
+    :param body: Raw XML of the response
+    :param request: Request XML to attach to the PyUPSException raised for
+                    an error response
+    """
+    rated_shipments = []
+    for element in _iter_elements(body, ('Error', 'RatedShipment')):
+        if element.tag == 'Error':
+            _check_error(element, request, body)
+            continue
+        rated_shipment = {
+            'ServiceCode': element.findtext('Service/Code'),
+            'CurrencyCode': element.findtext('TotalCharges/CurrencyCode'),
+            'TotalCharges': element.findtext('TotalCharges/MonetaryValue'),
+        }
+        negotiated_charges = element.findtext(
+            'NegotiatedRates/NetSummaryCharges/GrandTotal/MonetaryValue'
+        )
+        if negotiated_charges is not None:
+            rated_shipment['NegotiatedCharges'] = negotiated_charges
+        scheduled_delivery_time = element.findtext('ScheduledDeliveryTime')
+        if scheduled_delivery_time is not None:
+            rated_shipment['ScheduledDeliveryTime'] = scheduled_delivery_time
+        guaranteed_days = element.findtext('GuaranteedDaysToDelivery')
+        if guaranteed_days is not None:
+            rated_shipment['GuaranteedDaysToDelivery'] = \
+                _number(guaranteed_days)
+        rated_shipments.append(rated_shipment)
+    return rated_shipments
+
+
+def parse_shipment_response(body, request=None):
+    """
+    Return a dictionary of the values of a shipment confirm or accept
+    response with the keys:
+
+        CurrencyCode, TotalCharges, ShipmentIdentificationNumber,
+        ShipmentDigest (confirm only) and Packages, a list of dictionaries
+        with the TrackingNumber and GraphicImage of each package (accept
+        only)
+
+    :param body: Raw XML of the response
+    :param request: Request XML to attach to the PyUPSException raised for
+                    an error response
+    """
+    shipment = {'Packages': []}
+    for element in _iter_elements(body, (
+            'Error', 'ShipmentCharges', 'ShipmentIdentificationNumber',
+            'ShipmentDigest', 'PackageResults')):
+        if element.tag == 'Error':
+            _check_error(element, request, body)
+        elif element.tag == 'ShipmentCharges':
+            shipment['CurrencyCode'] = element.findtext(
+                'TotalCharges/CurrencyCode'
+            )
+            shipment['TotalCharges'] = element.findtext(
+                'TotalCharges/MonetaryValue'
+            )
+        elif element.tag == 'PackageResults':
+            shipment['Packages'].append({
+                'TrackingNumber': element.findtext('TrackingNumber'),
+                'GraphicImage': element.findtext('LabelImage/GraphicImage'),
+            })
+        else:
+            shipment[element.tag] = element.text
+    return shipment
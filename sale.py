@@ -6,16 +6,23 @@
     :license: BSD, see LICENSE for more details.
 """
 from decimal import Decimal
+import hashlib
 import math
+import sys
+from copy import deepcopy
 
 from lxml.builder import E
 from ups.rating_package import RatingService
 from ups.base import PyUPSException
+from trytond.cache import Cache
 from trytond.model import ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 
+from .api import request_many, single_flight, NETWORK_ERRORS
+from .cache import rate_cache
+from .profiling import phase, profiled
 __all__ = ['Configuration', 'Sale', 'SaleLine']
 __metaclass__ = PoolMeta
 
@@ -45,12 +52,50 @@ class Configuration:
     ups_package_type = fields.Selection(
         UPS_PACKAGE_TYPES, 'Package Content Type'
     )
+    _ups_defaults_cache = Cache(
+        'sale.configuration.ups_defaults', size_limit=1, context=False
+    )
 
     @staticmethod
     def default_ups_package_type():
         # This is the default value as specified in UPS doc
         return '02'
 
+    @classmethod
+    def create(cls, vlist):
+        cls._ups_defaults_cache.clear()
+        return super(Configuration, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._ups_defaults_cache.clear()
+        super(Configuration, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        cls._ups_defaults_cache.clear()
+        super(Configuration, cls).delete(records)
+
+    @classmethod
+    def get_ups_defaults(cls):
+        """
+        Return a dictionary of the default UPS service type id and package
+        type of the sales and shipments. It is kept in a cache until the
+        configuration is modified.
+        """
+        defaults = cls._ups_defaults_cache.get(None)
+        if defaults is None:
+            config = cls(1)
+            defaults = {
+                'ups_service_type': (
+                    config.ups_service_type.id
+                    if config.ups_service_type else None
+                ),
+                'ups_package_type': config.ups_package_type,
+            }
+            cls._ups_defaults_cache.set(None, defaults)
+        return defaults.copy()
+
 
 class Sale:
     "Sale"
@@ -67,10 +112,28 @@ class Sale:
         UPS_PACKAGE_TYPES, 'Package Content Type'
     )
     ups_saturday_delivery = fields.Boolean("Is Saturday Delivery")
+    ups_rate_fingerprint = fields.Char(
+        'UPS Rate Fingerprint', readonly=True,
+        help='Digest of the values the UPS shipping line was rated for.'
+    )
+    ups_rating_state = fields.Selection([
+        (None, ''),
+        ('pending', 'Pending'),
+        ('done', 'Rated'),
+        ('failed', 'Failed'),
+    ], 'UPS Rating State', readonly=True)
 
     @classmethod
     def __setup__(cls):
         super(Sale, cls).__setup__()
+        cls._error_messages.update({
+            'ups_service_type_missing': 'UPS service type missing.',
+            'ups_rating_failed':
+                'The UPS rating of the sale "%s" failed:\n%s',
+            'ups_rating_pending':
+                'The sale "%s" is being rated by UPS, retry later.',
+            'ups_no_rate': 'UPS returned no rate for the service "%s".',
+        })
         cls._buttons.update({
             'update_ups_shipment_cost': {
                 'invisible': Eval('state') != 'quotation'
@@ -80,19 +143,26 @@ class Sale:
     @staticmethod
     def default_ups_package_type():
         Config = Pool().get('sale.configuration')
-        config = Config(1)
-        return config.ups_package_type
+        return Config.get_ups_defaults()['ups_package_type']
 
     @staticmethod
     def default_ups_service_type():
         Config = Pool().get('sale.configuration')
-        config = Config(1)
-        return config.ups_service_type and config.ups_service_type.id or None
+        return Config.get_ups_defaults()['ups_service_type']
 
     @staticmethod
     def default_ups_saturday_delivery():
         return False
 
+    @classmethod
+    def copy(cls, sales, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('ups_rate_fingerprint', None)
+        default.setdefault('ups_rating_state', None)
+        return super(Sale, cls).copy(sales, default=default)
+
     def on_change_lines(self):
         """Pass a flag in context which indicates the get_sale_price method
         of ups carrier not to calculate cost on each line change
@@ -117,52 +187,246 @@ class Sale:
         context['sale'] = self.id
         return context
 
-    def apply_ups_shipping(self):
-        "Add a shipping line to sale for ups"
-        Sale = Pool().get('sale.sale')
+    def _get_ups_shipping_line_values(self, shipment_cost, currency_id):
+        """
+        Return the values to write on the sale to set its shipping line to
+        the given cost. The existing shipping line is updated in place and
+        only with the values which differ, so an empty dictionary is
+        returned if the sale is already up to date.
+        """
         Currency = Pool().get('currency.currency')
 
+        # Convert the shipping cost to sale currency from USD
+        shipment_cost = Currency.compute(
+            Currency(currency_id), shipment_cost, self.currency
+        )
+        line_values = {
+            'product': self.carrier.carrier_product.id,
+            'description': self.ups_service_type.name,
+            'quantity': 1,  # XXX
+            'unit': self.carrier.carrier_product.sale_uom.id,
+            'unit_price': shipment_cost,
+            'shipment_cost': shipment_cost,
+        }
+
+        values = {}
+        fingerprint = self._get_ups_shipping_fingerprint()
+        if fingerprint != self.ups_rate_fingerprint:
+            values['ups_rate_fingerprint'] = fingerprint
+
+        shipping_lines = [line for line in self.lines if line.shipment_cost]
+        if not shipping_lines:
+            line_values.update({
+                'type': 'line',
+                'amount': shipment_cost,
+                'taxes': [],
+                'sequence': 9999,  # XXX
+            })
+            values['lines'] = [('create', [line_values])]
+            return values
+
+        line = shipping_lines.pop(0)
+        changes = {}
+        for name, value in line_values.iteritems():
+            current = getattr(line, name)
+            if hasattr(current, 'id'):
+                current = current.id
+            if current != value:
+                changes[name] = value
+        if line.taxes:
+            changes['taxes'] = [('remove', [t.id for t in line.taxes])]
+
+        actions = []
+        if changes:
+            actions.append(('write', [line.id], changes))
+        if shipping_lines:
+            actions.append(('delete', [l.id for l in shipping_lines]))
+        if actions:
+            values['lines'] = actions
+        return values
+
+    def _get_ups_shipping_fingerprint(self):
+        """
+        Return a digest of all the values the shipping line of the sale
+        depends on: the rate request, the Saturday delivery flag, the
+        carrier and the currency of the sale
+        """
+        fingerprint = [
+            self._get_ups_rate_fingerprint(mode='rate'),
+            bool(self.ups_saturday_delivery),
+            self.carrier and self.carrier.id,
+            self.currency and self.currency.id,
+        ]
+        return hashlib.sha1('|'.join(map(unicode, fingerprint))).hexdigest()
+
+    def _is_ups_shipping_up_to_date(self):
+        """
+        Return True if the sale has a shipping line rated for its current
+        values, so there is no need to ask UPS again
+        """
+        return bool(
+            self.ups_rate_fingerprint
+            and any(line.shipment_cost for line in self.lines)
+            and self.ups_rate_fingerprint ==
+            self._get_ups_shipping_fingerprint()
+        )
+
+    @profiled
+    def apply_ups_shipping(self, force=False):
+        """
+        Add a shipping line to sale for ups
+
+        :param force: Rate the sale even if its shipping line is up to date
+        """
+        Sale = Pool().get('sale.sale')
+
         if self.is_ups_shipping:
+            with phase('read'):
+                if not force and self._is_ups_shipping_up_to_date():
+                    Sale._set_ups_rated([self])
+                    return
             with Transaction().set_context(self._get_carrier_context()):
                 shipment_cost, currency_id = self.carrier.get_sale_price()
                 if not shipment_cost:
                     return
-            # Convert the shipping cost to sale currency from USD
-            shipment_cost = Currency.compute(
-                Currency(currency_id), shipment_cost, self.currency
+            with phase('write'):
+                values = self._get_ups_shipping_line_values(
+                    shipment_cost, currency_id
+                )
+                if values:
+                    Sale.write([self], values)
+                Sale._set_ups_rated([self])
+
+    @classmethod
+    def apply_ups_shipping_concurrently(cls, sales, force=False):
+        """
+        Add the shipping lines to the sales rating them concurrently.
+
+        The sales missing from the cache are shopped together with
+        `get_ups_shipping_rates_many`. The price of each sale is then given
+        by its carrier as for `apply_ups_shipping`, with the shopped rates
+        in the context instead of calling UPS again, and the shipping lines
+        of all the sales are written at once. Unless force is set, the
+        sales whose shipping line is up to date are left untouched.
+        """
+        sales = [
+            sale for sale in sales if sale.is_ups_shipping and (
+                force or not sale._is_ups_shipping_up_to_date()
             )
-            Sale.write([self], {
-                'lines': [
-                    ('create', [{
-                        'type': 'line',
-                        'product': self.carrier.carrier_product.id,
-                        'description': self.ups_service_type.name,
-                        'quantity': 1,  # XXX
-                        'unit': self.carrier.carrier_product.sale_uom.id,
-                        'unit_price': shipment_cost,
-                        'shipment_cost': shipment_cost,
-                        'amount': shipment_cost,
-                        'taxes': [],
-                        'sequence': 9999,  # XXX
-                    }]),
-                    ('delete', [
-                        line for line in self.lines if line.shipment_cost
-                    ]),
-                ]
-            })
+        ]
+        to_shop = [
+            sale for sale in sales
+            if sale._get_ups_cached_shipping_cost() is None
+        ]
+        shop_rates = cls.get_ups_shipping_rates_many(to_shop)
+        ups_rates = dict(
+            (sale._get_ups_rate_fingerprint(mode='shop'), shop_rates[sale.id])
+            for sale in to_shop
+        )
+
+        to_write = []
+        rated = []
+        with Transaction().set_context(ups_rates=ups_rates):
+            for sale in sales:
+                with Transaction().set_context(sale._get_carrier_context()):
+                    shipment_cost, currency_id = \
+                        sale.carrier.get_sale_price()
+                if not shipment_cost:
+                    continue
+                values = sale._get_ups_shipping_line_values(
+                    shipment_cost, currency_id
+                )
+                if values:
+                    to_write.extend([[sale], values])
+                rated.append(sale)
+        if to_write:
+            cls.write(*to_write)
+        cls._set_ups_rated(rated)
+
+    @classmethod
+    def _set_ups_rated(cls, sales):
+        """
+        Mark the sales as rated and settle their rating jobs, the only
+        place where a rating succeeds
+        """
+        RatingJob = Pool().get('ups.rating.job')
+
+        sales = [
+            s for s in sales if s.ups_rating_state in ('pending', 'failed')
+        ]
+        if not sales:
+            return
+        RatingJob.settle(sales)
+        cls.write(sales, {'ups_rating_state': 'done'})
 
     @classmethod
     def quote(cls, sales):
+        UPSConfiguration = Pool().get('ups.configuration')
+        RatingJob = Pool().get('ups.rating.job')
+
         res = super(Sale, cls).quote(sales)
-        cls.update_ups_shipment_cost(sales)
+        if UPSConfiguration.get_snapshot().rate_in_background:
+            to_enqueue, up_to_date = [], []
+            for sale in sales:
+                if not sale.is_ups_shipping:
+                    continue
+                if sale._is_ups_shipping_up_to_date():
+                    up_to_date.append(sale)
+                else:
+                    to_enqueue.append(sale)
+            RatingJob.enqueue(to_enqueue)
+            cls._set_ups_rated(up_to_date)
+            return res
+        # Only the sales changed since they were last rated are rated again
+        cls._apply_ups_shipping_many(sales)
         return res
 
+    @classmethod
+    def confirm(cls, sales):
+        RatingJob = Pool().get('ups.rating.job')
+
+        # The sales quoted in background must have their shipping line
+        RatingJob.process(sales)
+        for sale in cls.browse(sales):
+            if sale.ups_rating_state == 'pending':
+                # Another transaction holds its job
+                cls.raise_user_error('ups_rating_pending', error_args=(
+                    sale.rec_name,
+                ))
+            if sale.ups_rating_state != 'failed':
+                continue
+            # A successful rating cancels the failures before it, so only
+            # the latest failures are left
+            jobs = RatingJob.search([
+                ('sale', '=', sale.id),
+                ('state', '=', 'failed'),
+            ], limit=1)
+            if jobs:
+                cls.raise_user_error('ups_rating_failed', error_args=(
+                    sale.rec_name, jobs[0].error
+                ))
+        super(Sale, cls).confirm(sales)
+
     @classmethod
     @ModelView.button
     def update_ups_shipment_cost(cls, sales):
         "Updates the shipping line with new value if any"
+        cls._apply_ups_shipping_many(sales, force=True)
+
+    @classmethod
+    def _apply_ups_shipping_many(cls, sales, force=False):
+        """
+        Apply the UPS shipping to the sales, concurrently if there are
+        several of them
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        ups_config = UPSConfiguration.get_snapshot()
+        if len(sales) > 1 and ups_config.rating_workers > 1:
+            cls.apply_ups_shipping_concurrently(sales, force=force)
+            return
         for sale in sales:
-            sale.apply_ups_shipping()
+            sale.apply_ups_shipping(force=force)
 
     def _update_ups_shipments(self):
         """
@@ -188,22 +452,29 @@ class Sale:
             self._update_ups_shipments()
         return shipments
 
+    def _get_ups_package_weight(self):
+        """
+        Return the total weight of the sale in the UPS weight UOM
+        """
+        SaleLine = Pool().get('sale.line')
+
+        with phase('read'):
+            return sum(SaleLine.get_weights_for_ups(self.lines))
+
     def _get_ups_packages(self):
         """
         Return UPS Packages XML
         """
         UPSConfiguration = Pool().get('ups.configuration')
 
-        ups_config = UPSConfiguration(1)
+        ups_config = UPSConfiguration.get_snapshot()
 
         package_type = RatingService.packaging_type(
             Code=self.ups_package_type
         )
 
         package_weight = RatingService.package_weight_type(
-            Weight=str(sum(map(
-                lambda line: line.get_weight_for_ups(), self.lines
-            ))),
+            Weight=str(self._get_ups_package_weight()),
             Code=ups_config.weight_uom_code,
         )
         package_service_options = RatingService.package_service_options_type(
@@ -222,6 +493,47 @@ class Sale:
         """
         return self.warehouse.address
 
+    def _get_rate_request_template(self, mode='rate'):
+        """
+        Return the parts of the rate request which only depend on the
+        warehouse and the UPS configuration: the shipper, the ship from
+        address, the negotiated rates flag and the request option. They are
+        built once per warehouse and kept with the XML of its address.
+
+        :param mode: 'rate' or 'shop' as in `_get_rate_request_xml`
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        ups_config = UPSConfiguration.get_snapshot()
+        shipper_address = self.warehouse.address
+        from_address = self._get_ship_from_address()
+
+        def build():
+            shipment_args = [
+                shipper_address.to_ups_shipper(),       # Shipper
+                from_address.to_ups_from_address(),     # Ship from
+            ]
+            if ups_config.negotiated_rates:
+                shipment_args.append(
+                    RatingService.rate_information_type(negotiated=True)
+                )
+            if mode == 'rate':
+                request_option = E.RequestOption('Rate')
+            else:
+                request_option = E.RequestOption('Shop')
+            # rating_request_type appends elements shared by the class,
+            # which lxml would move out of the request on the next call, so
+            # only a copy can be kept
+            return deepcopy(RatingService.rating_request_type(
+                E.Shipment(*shipment_args), RequestOption=request_option
+            ))
+
+        return shipper_address._get_ups_cached_xml(
+            'rate_request_%s' % mode, build,
+            from_address.id, from_address.write_date,
+            ups_config.shipper_no, ups_config.negotiated_rates
+        )
+
     def _get_rate_request_xml(self, mode='rate'):
         """
         Return the E builder object with the rate fetching request
@@ -230,95 +542,253 @@ class Sale:
                               package type
                      'shop' - to get a rates list
         """
-        UPSConfiguration = Pool().get('ups.configuration')
-
-        ups_config = UPSConfiguration(1)
-
         assert mode in ('rate', 'shop'), "Mode should be 'rate' or 'shop'"
 
         if mode == 'rate' and not self.ups_service_type:
             self.raise_user_error('ups_service_type_missing')
 
-        shipment_args = self._get_ups_packages()
-
-        shipment_args.extend([
-            self.warehouse.address.to_ups_shipper(),        # Shipper
-            self.shipment_address.to_ups_to_address(),      # Ship to
-            self._get_ship_from_address().to_ups_from_address(),   # Ship from
+        rate_request = self._get_rate_request_template(mode)
+        shipment = rate_request.find('Shipment')
 
-        ])
-
-        if ups_config.negotiated_rates:
-            shipment_args.append(
-                RatingService.rate_information_type(negotiated=True)
-            )
+        for index, package in enumerate(self._get_ups_packages()):
+            shipment.insert(index, package)
+        shipment.find('Shipper').addnext(
+            self.shipment_address.to_ups_to_address()       # Ship to
+        )
 
         if mode == 'rate':
             # TODO: handle ups_saturday_delivery
-            shipment_args.append(
+            shipment.append(
                 RatingService.service_type(Code=self.ups_service_type.code)
             )
-            request_option = E.RequestOption('Rate')
-        else:
-            request_option = E.RequestOption('Shop')
 
-        return RatingService.rating_request_type(
-            E.Shipment(*shipment_args), RequestOption=request_option
-        )
+        return rate_request
 
     def _get_rate_from_rated_shipment(cls, rated_shipment):
         """
-        The rated_shipment is an xml container in the response which has the
+        The rated_shipment is a dictionary of the values of a RatedShipment
+        of the response, as returned by `parse_rate_response`, which has the
         standard rates and negotiated rates. This method should extract the
         value and return it with the currency
         """
         Currency = Pool().get('currency.currency')
         UPSConfiguration = Pool().get('ups.configuration')
 
-        ups_config = UPSConfiguration(1)
+        ups_config = UPSConfiguration.get_snapshot()
 
-        currency, = Currency.search([
-            ('code', '=', str(rated_shipment.TotalCharges.CurrencyCode))
-        ])
+        currency = Currency.get_by_code(rated_shipment['CurrencyCode'])
         if ups_config.negotiated_rates and \
-                hasattr(rated_shipment, 'NegotiatedRates'):
+                'NegotiatedCharges' in rated_shipment:
             # If there are negotiated rates return that instead
-            charges = rated_shipment.NegotiatedRates.NetSummaryCharges
-            charges = currency.round(Decimal(
-                str(charges.GrandTotal.MonetaryValue)
-            ))
+            charges = currency.round(
+                Decimal(rated_shipment['NegotiatedCharges'])
+            )
         else:
             charges = currency.round(
-                Decimal(str(rated_shipment.TotalCharges.MonetaryValue))
+                Decimal(rated_shipment['TotalCharges'])
             )
         return charges, currency
 
+    def _get_ups_rate_fingerprint(self, mode='rate'):
+        """
+        Return a digest of the values which decide the answer UPS gives to
+        the request built by `_get_rate_request_xml` for the given mode
+
+        :param mode: 'rate' or 'shop' as in `_get_rate_request_xml`
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        ups_config = UPSConfiguration.get_snapshot()
+
+        def normalize_zip(address):
+            return (address.zip or '').replace(' ', '').upper()
+
+        def country_code(address):
+            return address.country and address.country.code or ''
+
+        shipper_address = self.warehouse.address
+        to_address = self.shipment_address
+        fingerprint = [
+            mode,
+            ups_config.shipper_no,
+            bool(ups_config.is_test),
+            bool(ups_config.negotiated_rates),
+            normalize_zip(shipper_address),
+            country_code(shipper_address),
+            normalize_zip(to_address),
+            country_code(to_address),
+            '%.2f' % self._get_ups_package_weight(),
+            self.ups_package_type,
+        ]
+        if mode == 'rate':
+            fingerprint.append(
+                self.ups_service_type and self.ups_service_type.code
+            )
+        return hashlib.sha1(
+            '|'.join(map(unicode, fingerprint)).encode('utf-8')
+        ).hexdigest()
+
+    @staticmethod
+    def _get_ups_single_flight_key(fingerprint):
+        """
+        Return the key under which identical rate requests made at the
+        same time by other transactions share a single call to UPS
+        """
+        return (Transaction().cursor.database_name, fingerprint)
+
+    @staticmethod
+    def _get_ups_transaction_rates():
+        """
+        Return the dictionary of the parsed rates by fingerprint got by the
+        current transaction when the rate cache is disabled. The cursor
+        empties it on commit and rollback.
+        """
+        return Transaction().cursor.cache.setdefault('ups_rates', {})
+
+    def _get_ups_cached_rates(self, fingerprint):
+        """
+        Return the parsed rates cached for the fingerprint, or given for it
+        in the context by `apply_ups_shipping_concurrently`, or None
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+        RateCache = Pool().get('ups.rate.cache')
+
+        rates = Transaction().context.get('ups_rates', {}).get(fingerprint)
+        if rates is not None:
+            return rates
+
+        ups_config = UPSConfiguration.get_snapshot()
+        if not ups_config.rate_cache_ttl:
+            return self._get_ups_transaction_rates().get(fingerprint)
+
+        key = (Transaction().cursor.database_name, fingerprint)
+        rates = rate_cache.get(key)
+        if rates is None and ups_config.shared_rate_cache:
+            cached = RateCache.get_rates(fingerprint)
+            if cached is not None:
+                # Warm the local cache only for the remaining lifetime
+                rates, ttl = cached
+                rate_cache.set(key, rates, ttl)
+        return rates
+
+    def _set_ups_cached_rates(self, fingerprint, rates):
+        """
+        Keep the parsed rates for the fingerprint in the rate cache
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+        RateCache = Pool().get('ups.rate.cache')
+
+        ups_config = UPSConfiguration.get_snapshot()
+        if not ups_config.rate_cache_ttl:
+            # Still kept for the other requests of the quotation
+            self._get_ups_transaction_rates()[fingerprint] = rates
+            return
+        if ups_config.rate_cache_size != rate_cache.size_limit \
+                and ups_config.rate_cache_size:
+            rate_cache.resize(ups_config.rate_cache_size)
+        rate_cache.set(
+            (Transaction().cursor.database_name, fingerprint), rates,
+            ups_config.rate_cache_ttl
+        )
+        if ups_config.shared_rate_cache:
+            RateCache.set_rates(fingerprint, rates, ups_config.rate_cache_ttl)
+
+    def _get_ups_cached_shipping_cost(self):
+        """
+        Return the cost and currency of the selected service if it is
+        cached either as a rate or in the shop rates, else None
+        """
+        if not self.ups_service_type:
+            self.raise_user_error('ups_service_type_missing')
+
+        rate = self._get_ups_cached_rates(self._get_ups_rate_fingerprint())
+        if rate is not None:
+            return tuple(rate)
+
+        shop_rates = self._get_ups_cached_rates(
+            self._get_ups_rate_fingerprint(mode='shop')
+        )
+        if shop_rates is not None:
+            return self._get_ups_service_rate(shop_rates)
+
+    @profiled
     def get_ups_shipping_cost(self):
         """Returns the calculated shipping cost as sent by ups
 
         :returns: The shipping cost with currency
         """
         UPSConfiguration = Pool().get('ups.configuration')
+        Capture = Pool().get('ups.capture')
 
-        ups_config = UPSConfiguration(1)
+        ups_config = UPSConfiguration.get_snapshot()
 
-        rate_request = self._get_rate_request_xml()
-        rate_api = ups_config.api_instance(call="rate")
+        with phase('read'):
+            rate = self._get_ups_cached_shipping_cost()
+        if rate is not None:
+            return rate
 
-        # Instead of shopping for rates, just get a price for the given
-        # service and package type to the destination we know.
-        rate_api.RequestOption = E.RequestOption('Rate')
+        # A single shop request answers for every service, and its result
+        # is cached for the next rate or shop request of this quotation.
+        try:
+            rates = self._get_ups_shipping_rates()
+        except PyUPSException:
+            # The selected service may still be rated on its own
+            rates = []
+        rate = self._get_ups_service_rate(rates)
+        if rate is not None:
+            return rate
+
+        # UPS did not shop the selected service, so ask a price for the
+        # given service and package type to the destination we know.
+        with phase('read'):
+            fingerprint = self._get_ups_rate_fingerprint()
+        with phase('build'):
+            rate_request = self._get_rate_request_xml()
+        rate_api = ups_config.api_instance(call="rate")
 
         try:
-            response = rate_api.request(rate_request)
+            with Capture.capture(self), phase('network'):
+                response = single_flight.do(
+                    self._get_ups_single_flight_key(fingerprint),
+                    rate_api.request_parsed, rate_request
+                )
         except PyUPSException, e:
             self.raise_user_error(unicode(e[0]))
+        except NETWORK_ERRORS:
+            return self._get_ups_fallback_service_rate(sys.exc_info())
 
-        shipment_cost, currency = self._get_rate_from_rated_shipment(
-            response.RatedShipment
-        )
+        if not response:
+            self.raise_user_error('ups_no_rate', error_args=(
+                self.ups_service_type.rec_name,
+            ))
+        with phase('parse'):
+            shipment_cost, currency = self._get_rate_from_rated_shipment(
+                response[0]
+            )
+        with phase('write'):
+            self._set_ups_cached_rates(
+                fingerprint, (shipment_cost, currency.id)
+            )
         return shipment_cost, currency.id
 
+    def _get_ups_service_rate(self, rates):
+        """
+        Return the cost and currency of the selected service from the shop
+        rates, or None if UPS did not quote that service
+        """
+        UPSService = Pool().get('ups.service')
+
+        service = UPSService.get_services_by_code().get(
+            self.ups_service_type.code
+        )
+        if service is None:
+            return None
+        service_id, _ = service
+        for rate_line in rates:
+            _, cost, currency_id, _, write_vals = rate_line
+            if write_vals['ups_service_type'] == service_id:
+                return cost, currency_id
+
     def _make_rate_line(self, rated_shipment):
         """
         Build a rate line from the rated shipment
@@ -326,56 +796,242 @@ class Sale:
         UPSService = Pool().get('ups.service')
 
         # First identify the service
-        service = UPSService.search([
-            ('code', '=', str(rated_shipment.Service.Code))
-        ])
+        service = UPSService.get_services_by_code().get(
+            rated_shipment['ServiceCode']
+        )
         if not service:
             return
+        service_id, service_name = service
 
         cost, currency = self._get_rate_from_rated_shipment(rated_shipment)
 
         # Extract metadata
         metadata = {}
-        if hasattr(rated_shipment, 'ScheduledDeliveryTime'):
-            metadata['ScheduledDeliveryTime'] = \
-                rated_shipment.ScheduledDeliveryTime.pyval
-        if hasattr(rated_shipment, 'GuaranteedDaysToDelivery'):
-            metadata['GuaranteedDaysToDelivery'] = \
-                rated_shipment.GuaranteedDaysToDelivery.pyval
+        for key in ('ScheduledDeliveryTime', 'GuaranteedDaysToDelivery'):
+            if key in rated_shipment:
+                metadata[key] = rated_shipment[key]
 
         # values that need to be written back to sale order
         write_vals = {
-            'ups_service_type': service[0].id,
+            'ups_service_type': service_id,
         }
 
         return (
-            service[0].name,        # Display name
+            service_name,           # Display name
             cost,
             currency.id,
             metadata,
             write_vals,
         )
 
+    @profiled
     def get_ups_shipping_rates(self):
         """
         Call the rates service and get possible quotes for shipping the product
         """
+        try:
+            return self._get_ups_shipping_rates()
+        except PyUPSException, e:
+            self.raise_user_error(unicode(e[0]))
+
+    def _get_ups_shipping_rates(self):
+        """
+        Return the rates as `get_ups_shipping_rates` does, but raise the
+        PyUPSException of a shop request refused by UPS
+        """
         UPSConfiguration = Pool().get('ups.configuration')
+        Capture = Pool().get('ups.capture')
+
+        ups_config = UPSConfiguration.get_snapshot()
 
-        ups_config = UPSConfiguration(1)
+        with phase('read'):
+            fingerprint = self._get_ups_rate_fingerprint(mode='shop')
+            rates = self._get_ups_cached_rates(fingerprint)
+            if rates is not None:
+                return map(tuple, rates)
 
-        rate_request = self._get_rate_request_xml(mode='shop')
+            if ups_config.rate_estimate == 'always':
+                rates = self._get_ups_estimated_rates()
+                if rates is not None:
+                    return rates
+
+        with phase('build'):
+            rate_request = self._get_rate_request_xml(mode='shop')
         rate_api = ups_config.api_instance(call="rate")
 
         try:
-            response = rate_api.request(rate_request)
-        except PyUPSException, e:
-            self.raise_user_error(unicode(e[0]))
+            with Capture.capture(self), phase('network'):
+                response = single_flight.do(
+                    self._get_ups_single_flight_key(fingerprint),
+                    rate_api.request_parsed, rate_request
+                )
+        except NETWORK_ERRORS:
+            return self._get_ups_fallback_rates(sys.exc_info(), fingerprint)
+
+        with phase('parse'):
+            rates = self._make_rate_lines(response)
+        with phase('write'):
+            self._set_ups_cached_rates(fingerprint, rates)
+        return rates
 
-        return filter(None, [
-            self._make_rate_line(rated_shipment)
-            for rated_shipment in response.iterchildren(tag='RatedShipment')
-        ])
+    @classmethod
+    def get_ups_shipping_rates_many(cls, sales):
+        """
+        Return a dictionary of the rates of each sale id as returned by
+        `get_ups_shipping_rates`.
+
+        The requests of all the sales missing from the cache are built
+        first and sent through a bounded pool of threads, so the time
+        spent waiting for UPS does not grow with the number of sales. The
+        sales with identical requests share a single call.
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+        Capture = Pool().get('ups.capture')
+
+        ups_config = UPSConfiguration.get_snapshot()
+
+        result = {}
+        to_shop = []
+        fingerprints = []
+        calls = []
+        captured = []
+        for sale in sales:
+            fingerprint = sale._get_ups_rate_fingerprint(mode='shop')
+            rates = sale._get_ups_cached_rates(fingerprint)
+            if rates is None and ups_config.rate_estimate == 'always':
+                rates = sale._get_ups_estimated_rates()
+            if rates is not None:
+                result[sale.id] = map(tuple, rates)
+                continue
+            to_shop.append((sale, fingerprint))
+            if fingerprint in fingerprints:
+                continue
+            captures = Capture.sample()
+            fingerprints.append(fingerprint)
+            calls.append((
+                ups_config.api_instance(call="rate"),
+                sale._get_rate_request_xml(mode='shop'),
+                sale._get_ups_single_flight_key(fingerprint),
+                captures,
+            ))
+            captured.append((sale, captures))
+
+        responses = dict(zip(
+            fingerprints,
+            request_many(calls, workers=ups_config.rating_workers)
+        ))
+        Capture.store(captured)
+
+        for sale, fingerprint in to_shop:
+            response, error = responses[fingerprint]
+            if isinstance(error, PyUPSException):
+                sale.raise_user_error(unicode(error[0]))
+            elif error is not None:
+                result[sale.id] = sale._get_ups_fallback_rates(
+                    (type(error), error, None), fingerprint
+                )
+                continue
+            rates = sale._make_rate_lines(response)
+            if fingerprint in fingerprints:
+                # Cached once for all the sales sharing the response
+                fingerprints.remove(fingerprint)
+                sale._set_ups_cached_rates(fingerprint, rates)
+            result[sale.id] = rates
+        return result
+
+    def _get_ups_estimated_rates(self):
+        """
+        Return the rate lines, as returned by `get_ups_shipping_rates`,
+        estimated from the UPS rate charts or None if the charts do not
+        cover the shipment. Only domestic shipments can be estimated.
+        """
+        RateZone = Pool().get('ups.rate.zone')
+        UPSService = Pool().get('ups.service')
+
+        shipper_address = self.warehouse.address
+        to_address = self.shipment_address
+        if not shipper_address.country \
+                or shipper_address.country != to_address.country:
+            return None
+
+        rate_table = RateZone.get_rate_table()
+        weight = self._get_ups_package_weight()
+        services = UPSService.get_services_by_code()
+        rates = []
+        for code in rate_table.services():
+            if code not in services:
+                continue
+            price = rate_table.price(
+                code, shipper_address.zip, to_address.zip, weight
+            )
+            if price is None:
+                continue
+            service_id, service_name = services[code]
+            cost, currency_id = price
+            rates.append((
+                service_name,
+                cost,
+                currency_id,
+                {'Estimated': True},
+                {'ups_service_type': service_id},
+            ))
+        return rates or None
+
+    def _get_ups_stale_rates(self, fingerprint):
+        """
+        Return the rate lines last cached for the fingerprint even if they
+        have expired, or None
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        if not UPSConfiguration.get_snapshot().rate_cache_ttl:
+            return None
+        rates = rate_cache.get_stale(
+            (Transaction().cursor.database_name, fingerprint)
+        )
+        if rates is None:
+            return None
+        for _, _, _, metadata, _ in rates:
+            metadata['Stale'] = True
+        return map(tuple, rates)
+
+    def _get_ups_fallback_rates(self, exc_info, fingerprint):
+        """
+        Return the expired cached rates or the estimated rates when UPS
+        could not be reached, or raise a user error with the network error
+        given as a sys.exc_info() tuple
+
+        :param fingerprint: Fingerprint of the shop request which failed
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        ups_config = UPSConfiguration.get_snapshot()
+        rates = self._get_ups_stale_rates(fingerprint)
+        if rates is None and ups_config.rate_estimate == 'fallback':
+            rates = self._get_ups_estimated_rates()
+        if rates is None:
+            self.raise_user_error(unicode(exc_info[1]))
+        return rates
+
+    def _get_ups_fallback_service_rate(self, exc_info):
+        """
+        Return the cost and currency of the selected service from the
+        fallback rates when its rate request could not reach UPS, or raise
+        a user error with the network error given as a sys.exc_info() tuple
+        """
+        rate = self._get_ups_service_rate(self._get_ups_fallback_rates(
+            exc_info, self._get_ups_rate_fingerprint(mode='shop')
+        ))
+        if rate is None:
+            self.raise_user_error(unicode(exc_info[1]))
+        return rate
+
+    def _make_rate_lines(self, response):
+        """
+        Build the rate lines of all the rated shipments of a shop response
+        as returned by `parse_rate_response`
+        """
+        return filter(None, map(self._make_rate_line, response))
 
 
 class SaleLine:
@@ -389,41 +1045,59 @@ class SaleLine:
             'weight_required': 'Weight is missing on the product %s',
         })
 
-    def get_weight_for_ups(self):
+    @classmethod
+    def get_weights_for_ups(cls, lines):
         """
-        Returns weight as required for ups.
+        Returns the list of the weights as required for ups of the lines.
+
+        The UPS configuration and its weight UOM are read once for all the
+        lines instead of once per line.
         """
         ProductUom = Pool().get('product.uom')
         UPSConfiguration = Pool().get('ups.configuration')
 
-        ups_config = UPSConfiguration(1)
-        if self.product.type == 'service' or self.quantity <= 0:
-            return 0
+        ups_config = UPSConfiguration.get_snapshot()
+        weight_uom = ProductUom(ups_config.weight_uom)
+
+        weights = []
+        for line in lines:
+            product = line.product
+            if not product or product.type == 'service' \
+                    or line.quantity <= 0:
+                weights.append(0)
+                continue
+
+            if not product.weight:
+                cls.raise_user_error(
+                    'weight_required',
+                    error_args=(product.name,)
+                )
+
+            # Find the quantity in the default uom of the product as the
+            # weight is for per unit in that uom
+            if line.unit != product.default_uom:
+                quantity = ProductUom.compute_qty_by_factor(
+                    line.unit,
+                    line.quantity,
+                    product.default_uom
+                )
+            else:
+                quantity = line.quantity
+
+            weight = float(product.weight) * quantity
+
+            # Convert weights according to UPS
+            if product.weight_uom != weight_uom:
+                weight = ProductUom.compute_qty_by_factor(
+                    product.weight_uom,
+                    weight,
+                    weight_uom
+                )
+            weights.append(math.ceil(weight))
+        return weights
 
-        if not self.product.weight:
-            self.raise_user_error(
-                'weight_required',
-                error_args=(self.product.name,)
-            )
-
-        # Find the quantity in the default uom of the product as the weight
-        # is for per unit in that uom
-        if self.unit != self.product.default_uom:
-            quantity = ProductUom.compute_qty(
-                self.unit,
-                self.quantity,
-                self.product.default_uom
-            )
-        else:
-            quantity = self.quantity
-
-        weight = float(self.product.weight) * quantity
-
-        # Convert weights according to UPS
-        if self.product.weight_uom != ups_config.weight_uom:
-            weight = ProductUom.compute_qty(
-                self.product.weight_uom,
-                weight,
-                ups_config.weight_uom
-            )
-        return math.ceil(weight)
+    def get_weight_for_ups(self):
+        """
+        Returns weight as required for ups.
+        """
+        return self.get_weights_for_ups([self])[0]
@@ -7,10 +7,15 @@
 """
 from decimal import Decimal
 import base64
+import hashlib
 import math
+from copy import deepcopy
 
+from lxml import etree
 from ups.shipping_package import ShipmentConfirm, ShipmentAccept
 from ups.base import PyUPSException
+from trytond import backend
+from trytond.exceptions import UserError
 from trytond.model import ModelView, fields
 from trytond.wizard import Wizard, StateView, Button
 from trytond.transaction import Transaction
@@ -18,7 +23,10 @@ from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.rpc import RPC
 
+from .api import request_many, batch_priority, NETWORK_ERRORS
+from .profiling import phase, profiled
 from .sale import UPS_PACKAGE_TYPES
+from .tools import autonomous_transaction
 
 
 __metaclass__ = PoolMeta
@@ -31,6 +39,15 @@ STATES = {
 }
 
 
+def _error_message(error):
+    """
+    Return the message of a PyUPSException or network error
+    """
+    if isinstance(error, PyUPSException):
+        return unicode(error[0])
+    return unicode(error)
+
+
 class ShipmentOut:
     "Shipment Out"
     __name__ = 'stock.shipment.out'
@@ -50,23 +67,42 @@ class ShipmentOut:
         "Is Saturday Delivery", states=STATES, depends=['state']
     )
     tracking_number = fields.Char('Tracking Number', states=STATES)
+    ups_shipment_digest = fields.Text('UPS Shipment Digest', readonly=True)
+    ups_confirm_fingerprint = fields.Char(
+        'UPS Confirm Fingerprint', readonly=True
+    )
+    ups_confirmed_cost = fields.Numeric(
+        'UPS Confirmed Cost', digits=(16, 2), readonly=True
+    )
+    ups_confirmed_cost_currency = fields.Many2One(
+        'currency.currency', 'UPS Confirmed Cost Currency', readonly=True
+    )
 
     @staticmethod
     def default_ups_package_type():
         Config = Pool().get('sale.configuration')
-        config = Config(1)
-        return config.ups_package_type
+        return Config.get_ups_defaults()['ups_package_type']
 
     @staticmethod
     def default_ups_service_type():
         Config = Pool().get('sale.configuration')
-        config = Config(1)
-        return config.ups_service_type and config.ups_service_type.id or None
+        return Config.get_ups_defaults()['ups_service_type']
 
     @staticmethod
     def default_ups_saturday_delivery():
         return False
 
+    @classmethod
+    def copy(cls, shipments, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('ups_shipment_digest', None)
+        default.setdefault('ups_confirm_fingerprint', None)
+        default.setdefault('ups_confirmed_cost', None)
+        default.setdefault('ups_confirmed_cost_currency', None)
+        return super(ShipmentOut, cls).copy(shipments, default=default)
+
     def get_is_ups_shipping(self, name):
         """
         Check if shipping is from UPS
@@ -88,9 +124,13 @@ class ShipmentOut:
                 'Tracking Number is already present for this shipment.',
             'invalid_state': 'Labels can only be generated when the '
                 'shipment is in Packed or Done states only',
+            'invalid_confirm_state': 'Draft or cancelled shipments can not '
+                'be confirmed to UPS.',
         })
         cls.__rpc__.update({
             'make_ups_labels': RPC(readonly=False, instantiate=0),
+            'make_ups_labels_many': RPC(readonly=False, instantiate=0),
+            'confirm_ups_labels': RPC(readonly=False, instantiate=0),
             'get_ups_shipping_cost': RPC(readonly=False, instantiate=0),
         })
 
@@ -99,16 +139,17 @@ class ShipmentOut:
         Return UPS Packages XML
         """
         UPSConfiguration = Pool().get('ups.configuration')
+        StockMove = Pool().get('stock.move')
 
-        ups_config = UPSConfiguration(1)
+        ups_config = UPSConfiguration.get_snapshot()
         package_type = ShipmentConfirm.packaging_type(
             Code=self.ups_package_type
         )  # FIXME: Support multiple packaging type
 
+        with phase('read'):
+            weight = sum(StockMove.get_weights_for_ups(self.outgoing_moves))
         package_weight = ShipmentConfirm.package_weight_type(
-            Weight=str(sum(map(
-                lambda move: move.get_weight_for_ups(), self.outgoing_moves
-            ))),
+            Weight=str(weight),
             Code=ups_config.weight_uom_code,
         )
         package_service_options = ShipmentConfirm.package_service_options_type(
@@ -138,7 +179,7 @@ class ShipmentOut:
         """
         UPSConfiguration = Pool().get('ups.configuration')
 
-        ups_config = UPSConfiguration(1)
+        ups_config = UPSConfiguration.get_snapshot()
         if not self.ups_service_type:
             self.raise_user_error('ups_service_type_missing')
 
@@ -165,6 +206,7 @@ class ShipmentOut:
             )
         return shipment_confirm
 
+    @profiled
     def get_ups_shipping_cost(self):
         """Returns the calculated shipping cost as sent by ups
 
@@ -172,41 +214,34 @@ class ShipmentOut:
         """
         UPSConfiguration = Pool().get('ups.configuration')
         Currency = Pool().get('currency.currency')
+        Capture = Pool().get('ups.capture')
 
-        ups_config = UPSConfiguration(1)
+        ups_config = UPSConfiguration.get_snapshot()
 
-        shipment_confirm = self._get_shipment_confirm_xml()
+        with phase('build'):
+            shipment_confirm = self._get_shipment_confirm_xml()
         shipment_confirm_instance = ups_config.api_instance(call="confirm")
 
         try:
-            response = shipment_confirm_instance.request(shipment_confirm)
-        except PyUPSException, e:
-            self.raise_user_error(unicode(e[0]))
+            with Capture.capture(self), phase('network'):
+                response = shipment_confirm_instance.request_parsed(
+                    shipment_confirm
+                )
+        except (PyUPSException,) + NETWORK_ERRORS, e:
+            self.raise_user_error(_error_message(e))
 
-        currency, = Currency.search([
-            ('code', '=', str(
-                response.ShipmentCharges.TotalCharges.CurrencyCode
-            ))
-        ])
+        with phase('read'):
+            currency = Currency.get_by_code(response['CurrencyCode'])
 
-        shipping_cost = currency.round(Decimal(
-            str(response.ShipmentCharges.TotalCharges.MonetaryValue)
-        ))
+        shipping_cost = currency.round(Decimal(response['TotalCharges']))
         return shipping_cost, currency.id
 
-    def make_ups_labels(self):
+    def _check_ups_confirm(self):
         """
-        Make labels for the given shipment
-
-        :return: Tracking number as string
+        Raise an error if the shipment can not be confirmed to UPS
         """
-        Attachment = Pool().get('ir.attachment')
-        UPSConfiguration = Pool().get('ups.configuration')
-        Currency = Pool().get('currency.currency')
-
-        ups_config = UPSConfiguration(1)
-        if self.state not in ('packed', 'done'):
-            self.raise_user_error('invalid_state')
+        if self.state in ('draft', 'cancel'):
+            self.raise_user_error('invalid_confirm_state')
 
         if not self.is_ups_shipping:
             self.raise_user_error('ups_wrong_carrier')
@@ -214,64 +249,405 @@ class ShipmentOut:
         if self.tracking_number:
             self.raise_user_error('tracking_number_already_present')
 
-        shipment_confirm = self._get_shipment_confirm_xml()
-        shipment_confirm_instance = ups_config.api_instance(call="confirm")
+    def _check_ups_label(self):
+        """
+        Raise an error if the labels of the shipment can not be made
+        """
+        if self.state not in ('packed', 'done'):
+            self.raise_user_error('invalid_state')
 
-        try:
-            response = shipment_confirm_instance.request(shipment_confirm)
-        except PyUPSException, e:
-            self.raise_user_error(unicode(e[0]))
+        self._check_ups_confirm()
+
+    def _get_ups_confirm_fingerprint(self, shipment_confirm):
+        """
+        Return a digest of the confirm request of the shipment, which tells
+        if the ShipmentDigest stored by an earlier confirmation still
+        describes the shipment
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        ups_config = UPSConfiguration.get_snapshot()
+        fingerprint = [
+            ups_config.shipper_no,
+            bool(ups_config.is_test),
+            etree.tostring(shipment_confirm),
+        ]
+        return hashlib.sha1('|'.join(map(unicode, fingerprint))).hexdigest()
 
-        digest = ShipmentConfirm.extract_digest(response)
+    def _get_ups_confirmed_digest(self, fingerprint):
+        """
+        Return the ShipmentDigest stored for the confirm request with the
+        fingerprint or None
+        """
+        if self.ups_shipment_digest \
+                and self.ups_confirm_fingerprint == fingerprint:
+            return self.ups_shipment_digest
+        return None
 
-        shipment_accept = ShipmentAccept.shipment_accept_request_type(digest)
+    def _get_ups_confirm_values(self, response, fingerprint):
+        """
+        Return the values to store on the shipment from the parsed confirm
+        response of the request with the fingerprint
+        """
+        Currency = Pool().get('currency.currency')
 
-        shipment_accept_instance = ups_config.api_instance(call="accept")
+        currency = Currency.get_by_code(response['CurrencyCode'])
+        return {
+            'ups_shipment_digest': response['ShipmentDigest'],
+            'ups_confirm_fingerprint': fingerprint,
+            'ups_confirmed_cost': currency.round(
+                Decimal(response['TotalCharges'])
+            ),
+            'ups_confirmed_cost_currency': currency.id,
+        }
 
-        try:
-            response = shipment_accept_instance.request(shipment_accept)
-        except PyUPSException, e:
-            self.raise_user_error(unicode(e[0]))
+    def _get_ups_label_values(self, shipment_res):
+        """
+        Return a tuple of the values to write on the shipment and of the
+        list of the values of its label attachments from the parsed accept
+        response.
 
-        if len(response.ShipmentResults.PackageResults) > 1:
-            self.raise_user_error('ups_multiple_packages_not_supported')
+        UPS has created the shipment once it is accepted, so nothing of the
+        response may be dropped: a shipment of several packages is tracked
+        by its identification number and gets the label of each package.
+        """
+        Currency = Pool().get('currency.currency')
 
-        shipment_res = response.ShipmentResults
-        package, = shipment_res.PackageResults
-        tracking_number = package.TrackingNumber.pyval
+        packages = shipment_res['Packages']
+        if len(packages) == 1:
+            tracking_number = packages[0]['TrackingNumber']
+        else:
+            tracking_number = shipment_res['ShipmentIdentificationNumber']
 
-        currency, = Currency.search([
-            ('code', '=', str(
-                shipment_res.ShipmentCharges.TotalCharges.CurrencyCode
-            ))
-        ])
-        shipping_cost = currency.round(Decimal(
-            str(shipment_res.ShipmentCharges.TotalCharges.MonetaryValue)
-        ))
-        self.__class__.write([self], {
+        currency = Currency.get_by_code(shipment_res['CurrencyCode'])
+        shipping_cost = currency.round(
+            Decimal(shipment_res['TotalCharges'])
+        )
+        return {
             'tracking_number': unicode(tracking_number),
             'cost': shipping_cost,
             'cost_currency': currency,
-        })
-
-        Attachment.create([{
+            # A digest can be accepted only once
+            'ups_shipment_digest': None,
+            'ups_confirm_fingerprint': None,
+        }, [{
             'name': "%s_%s_.png" % (
-                tracking_number,
-                shipment_res.ShipmentIdentificationNumber.pyval
+                package['TrackingNumber'],
+                shipment_res['ShipmentIdentificationNumber']
             ),
-            'data': buffer(base64.decodestring(
-                package.LabelImage.GraphicImage.pyval
-            )),
+            'data': buffer(base64.decodestring(package['GraphicImage'])),
             'resource': '%s,%s' % (self.__name__, self.id)
-        }])
+        } for package in packages if package['GraphicImage']]
+
+    @classmethod
+    def _confirm_ups_many(cls, shipments, captures=None):
+        """
+        Return the ShipmentDigest of each shipment.
+
+        The digest stored by an earlier confirmation is reused as long as
+        the confirm request of the shipment has not changed. The other
+        shipments are confirmed through a bounded pool of threads. Nothing
+        is written, the callers store the values of the confirmations so a
+        failed accept can later be retried without confirming again.
+
+        :param captures: A dictionary with for each shipment id the list to
+                         capture its requests into or None, which the
+                         caller stores. By default the shipments are sampled
+                         and their captures stored here.
+        :return: A dictionary with for each shipment id a tuple of the
+                 digest, the values to write on the shipment if it was
+                 confirmed now, else None, and None, or of None, None and
+                 the error message
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+        Capture = Pool().get('ups.capture')
+
+        ups_config = UPSConfiguration.get_snapshot()
+
+        store_captures = captures is None
+        if store_captures:
+            captures = dict((s.id, Capture.sample()) for s in shipments)
+
+        result = {}
+        to_confirm = []
+        calls = []
+        for shipment in shipments:
+            try:
+                # pyups moves elements shared by its class into each new
+                # request, so the request is copied before building the next
+                with phase('build'):
+                    request = deepcopy(shipment._get_shipment_confirm_xml())
+                    fingerprint = shipment._get_ups_confirm_fingerprint(
+                        request
+                    )
+            except UserError, e:
+                result[shipment.id] = (None, None, e.message)
+                continue
+            with phase('read'):
+                digest = shipment._get_ups_confirmed_digest(fingerprint)
+            if digest:
+                result[shipment.id] = (digest, None, None)
+                continue
+            to_confirm.append((shipment, fingerprint))
+            calls.append((
+                ups_config.api_instance(call="confirm"), request, None,
+                captures[shipment.id],
+            ))
+
+        with phase('network'):
+            responses = request_many(
+                calls, workers=ups_config.rating_workers
+            )
+        if store_captures:
+            Capture.store([(s, captures[s.id]) for s in shipments])
+
+        for (shipment, fingerprint), (response, error) in \
+                zip(to_confirm, responses):
+            if error is not None:
+                result[shipment.id] = (None, None, _error_message(error))
+                continue
+            result[shipment.id] = (
+                response['ShipmentDigest'],
+                shipment._get_ups_confirm_values(response, fingerprint),
+                None,
+            )
+        return result
+
+    @classmethod
+    def confirm_ups_labels(cls, shipments):
+        """
+        Confirm the shipments to UPS ahead of making their labels, which
+        then only needs the accept call.
+
+        :return: A dictionary with for each shipment id the error message
+                 or None
+        """
+        result = {}
+        to_confirm = []
+        for shipment in shipments:
+            try:
+                shipment._check_ups_confirm()
+            except UserError, e:
+                result[shipment.id] = e.message
+                continue
+            to_confirm.append(shipment)
+
+        to_write = []
+        with batch_priority():
+            confirmed = cls._confirm_ups_many(to_confirm)
+        for shipment in to_confirm:
+            _, values, error = confirmed[shipment.id]
+            result[shipment.id] = error
+            if values:
+                to_write.extend([[shipment], values])
+        if to_write:
+            with phase('write'):
+                cls.write(*to_write)
+        return result
+
+    @profiled
+    def make_ups_labels(self):
+        """
+        Make labels for the given shipment
+
+        :return: Tracking number as string
+        """
+        Attachment = Pool().get('ir.attachment')
+        Capture = Pool().get('ups.capture')
+
+        self._check_ups_label()
+
+        captures = {self.id: Capture.sample()}
+        try:
+            result, to_write, attachments = self._make_ups_labels(
+                [self], captures
+            )
+        finally:
+            Capture.store([(self, captures[self.id])])
+
+        tracking_number, error = result[self.id]
+        if error is not None:
+            # The error rolls back the transaction, but not the digest
+            # of a confirmation whose accept call must only be retried
+            if to_write:
+                self._write_ups_autonomously(to_write)
+            self.raise_user_error(error)
+
+        with phase('write'):
+            self.__class__.write(*to_write)
+            Attachment.create(attachments)
         return tracking_number
 
+    @classmethod
+    def _write_ups_autonomously(cls, to_write):
+        """
+        Write the shipments in a transaction of their own, as by
+        `autonomous_transaction`. If the current transaction has locked
+        them, waiting for it would never end so they are written in it.
+
+        :param to_write: The arguments of the write of the shipments
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        ids = [s.id for shipments in to_write[::2] for s in shipments]
+        with autonomous_transaction() as autonomous:
+            if autonomous:
+                cursor = Transaction().cursor
+                try:
+                    cursor.execute(
+                        'SELECT id FROM "%s" WHERE id IN (%s) '
+                        'FOR UPDATE NOWAIT' % (
+                            cls._table, ', '.join(['%s'] * len(ids))
+                        ), ids
+                    )
+                except DatabaseOperationalError:
+                    cursor.rollback()
+                    autonomous = False
+                else:
+                    cls.write(*to_write)
+        if not autonomous:
+            cls.write(*to_write)
+
+    @classmethod
+    def make_ups_labels_many(cls, shipments):
+        """
+        Make the labels of many shipments at once.
+
+        The shipments are confirmed as by `_confirm_ups_many`, then their
+        accept requests are sent through a bounded pool of threads and the
+        results are written with a single write and a single creation of
+        attachments. A shipment which fails does not stop the others.
+
+        :return: A dictionary with for each shipment id a tuple of the
+                 tracking number and None, or None and the error message
+        """
+        Attachment = Pool().get('ir.attachment')
+        Capture = Pool().get('ups.capture')
+
+        result = {}
+        to_make = []
+        for shipment in shipments:
+            try:
+                shipment._check_ups_label()
+            except UserError, e:
+                result[shipment.id] = (None, e.message)
+                continue
+            to_make.append(shipment)
+
+        captures = dict((s.id, Capture.sample()) for s in to_make)
+        try:
+            # Bulk labels give way to the interactive requests to UPS
+            with batch_priority():
+                made, to_write, attachments = cls._make_ups_labels(
+                    to_make, captures
+                )
+        finally:
+            Capture.store([(s, captures[s.id]) for s in to_make])
+        result.update(made)
+
+        if to_write:
+            cls.write(*to_write)
+        if attachments:
+            Attachment.create(attachments)
+        return result
+
+    @classmethod
+    def _make_ups_labels(cls, shipments, captures):
+        """
+        Confirm and accept the shipments without writing anything.
+
+        :param captures: A dictionary with for each shipment id the list to
+                         capture its requests into or None
+        :return: A tuple of the result of each shipment as returned by
+                 `make_ups_labels_many`, of the arguments of the write of
+                 the shipments and of the values of their label attachments
+        """
+        result = {}
+        to_accept = []
+        confirm_values = {}
+        confirmed = cls._confirm_ups_many(shipments, captures)
+        for shipment in shipments:
+            digest, confirm_values[shipment.id], error = \
+                confirmed[shipment.id]
+            if error is not None:
+                result[shipment.id] = (None, error)
+                continue
+            to_accept.append((shipment, digest))
+
+        responses = cls._accept_ups_many(to_accept, captures)
+
+        to_write = []
+        attachments = []
+        for (shipment, _), (response, error) in zip(to_accept, responses):
+            tracking_number, error, values, labels = \
+                shipment._get_ups_accept_result(
+                    response, error, confirm_values[shipment.id]
+                )
+            result[shipment.id] = (tracking_number, error)
+            if values:
+                to_write.extend([[shipment], values])
+            attachments.extend(labels)
+        return result, to_write, attachments
+
+    @classmethod
+    def _accept_ups_many(cls, digests, captures):
+        """
+        Send the accept requests of the confirmed shipments through a
+        bounded pool of threads
+
+        :param digests: A list of tuples of (shipment, ShipmentDigest)
+        :param captures: A dictionary with for each shipment id the list to
+                         capture its requests into or None
+        :return: A list of tuples of (parsed response, error or None) in
+                 the same order as the digests
+        """
+        UPSConfiguration = Pool().get('ups.configuration')
+
+        ups_config = UPSConfiguration.get_snapshot()
+
+        calls = []
+        for shipment, digest in digests:
+            with phase('build'):
+                request = deepcopy(
+                    ShipmentAccept.shipment_accept_request_type(digest)
+                )
+            calls.append((
+                ups_config.api_instance(call="accept"), request, None,
+                captures[shipment.id],
+            ))
+        with phase('network'):
+            return request_many(calls, workers=ups_config.rating_workers)
+
+    def _get_ups_accept_result(self, response, error, confirm_values):
+        """
+        Return a tuple of the tracking number, of the error message, of the
+        values to write on the shipment, each None if not relevant, and of
+        the list of the values of its label attachments from the outcome of
+        the accept request of the shipment
+
+        :param confirm_values: The values of the confirmation of the
+                               shipment if it was confirmed for this accept
+                               request, else None
+        """
+        if error is None:
+            values, labels = self._get_ups_label_values(response)
+            return values['tracking_number'], None, values, labels
+        if isinstance(error, PyUPSException):
+            # UPS refused the digest, the next attempt must confirm again.
+            # It is kept on network errors to only retry the accept call.
+            return None, _error_message(error), {
+                'ups_shipment_digest': None,
+                'ups_confirm_fingerprint': None,
+            }, []
+        return None, _error_message(error), confirm_values, []
+
 
 class GenerateUPSLabelMessage(ModelView):
     'Generate UPS Labels Message'
     __name__ = 'generate.ups.label.message'
 
     tracking_number = fields.Char("Tracking number", readonly=True)
+    report = fields.Text("Report", readonly=True)
 
 
 class GenerateUPSLabel(Wizard):
@@ -289,16 +665,21 @@ class GenerateUPSLabel(Wizard):
     def default_start(self, data):
         Shipment = Pool().get('stock.shipment.out')
 
-        try:
-            shipment, = Shipment.browse(Transaction().context['active_ids'])
-        except ValueError:
-            self.raise_user_error(
-                'This wizard can be called for only one shipment at a time'
-            )
-
-        tracking_number = shipment.make_ups_labels()
+        shipments = Shipment.browse(Transaction().context['active_ids'])
+        if len(shipments) == 1:
+            shipment, = shipments
+            tracking_number = shipment.make_ups_labels()
+            return {'tracking_number': str(tracking_number)}
 
-        return {'tracking_number': str(tracking_number)}
+        result = Shipment.make_ups_labels_many(shipments)
+        report = []
+        for shipment in shipments:
+            tracking_number, error = result[shipment.id]
+            if error is None:
+                report.append(u'%s: %s' % (shipment.rec_name, tracking_number))
+            else:
+                report.append(u'%s: %s' % (shipment.rec_name, error))
+        return {'report': u'\n'.join(report)}
 
 
 class StockMove:
@@ -313,41 +694,58 @@ class StockMove:
                 'Weight for product %s in stock move is missing',
         })
 
-    def get_weight_for_ups(self):
+    @classmethod
+    def get_weights_for_ups(cls, moves):
         """
-        Returns weight as required for ups
+        Returns the list of the weights as required for ups of the moves.
+
+        The UPS configuration and its weight UOM are read once for all the
+        moves instead of once per move.
         """
         ProductUom = Pool().get('product.uom')
         UPSConfiguration = Pool().get('ups.configuration')
 
-        ups_config = UPSConfiguration(1)
-        if self.product.type == 'service':
-            return 0
-
-        if not self.product.weight:
-            self.raise_user_error(
-                'weight_required',
-                error_args=(self.product.name,)
-            )
-
-        # Find the quantity in the default uom of the product as the weight
-        # is for per unit in that uom
-        if self.uom != self.product.default_uom:
-            quantity = ProductUom.compute_qty(
-                self.uom,
-                self.quantity,
-                self.product.default_uom
-            )
-        else:
-            quantity = self.quantity
-
-        weight = float(self.product.weight) * quantity
+        ups_config = UPSConfiguration.get_snapshot()
+        weight_uom = ProductUom(ups_config.weight_uom)
+
+        weights = []
+        for move in moves:
+            product = move.product
+            if product.type == 'service':
+                weights.append(0)
+                continue
+
+            if not product.weight:
+                cls.raise_user_error(
+                    'weight_required',
+                    error_args=(product.name,)
+                )
+
+            # Find the quantity in the default uom of the product as the
+            # weight is for per unit in that uom
+            if move.uom != product.default_uom:
+                quantity = ProductUom.compute_qty_by_factor(
+                    move.uom,
+                    move.quantity,
+                    product.default_uom
+                )
+            else:
+                quantity = move.quantity
+
+            weight = float(product.weight) * quantity
+
+            # Convert weights according to UPS
+            if product.weight_uom != weight_uom:
+                weight = ProductUom.compute_qty_by_factor(
+                    product.weight_uom,
+                    weight,
+                    weight_uom
+                )
+            weights.append(math.ceil(weight))
+        return weights
 
-        # Convert weights according to UPS
-        if self.product.weight_uom != ups_config.weight_uom:
-            weight = ProductUom.compute_qty(
-                self.product.weight_uom,
-                weight,
-                ups_config.weight_uom
-            )
-        return math.ceil(weight)
+    def get_weight_for_ups(self):
+        """
+        Returns weight as required for ups
+        """
+        return self.get_weights_for_ups([self])[0]
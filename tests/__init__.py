@@ -11,6 +11,18 @@ import trytond.tests.test_tryton
 
 from tests.test_views_depends import TestViewsDepends
 from tests.test_ups import TestUPS
+from tests.test_cache import TestTTLCache, TestRateCache
+from tests.test_rate_table import TestRateTable
+from tests.test_uom import TestUom
+from tests.test_registry import TestRegistry
+from tests.test_response import TestResponse
+from tests.test_api import TestConnectionPool, TestSingleFlight, TestRetry, \
+    TestRateLimit, TestSharedRateLimit
+from tests.test_metrics import TestCallMetrics
+from tests.test_capture import TestCapture
+from tests.test_profiling import TestProfile
+from tests.test_sale import TestSale
+from tests.test_stock import TestShipment
 
 
 def suite():
@@ -21,6 +33,22 @@ def suite():
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestViewsDepends),
         unittest.TestLoader().loadTestsFromTestCase(TestUPS),
+        unittest.TestLoader().loadTestsFromTestCase(TestTTLCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestRateCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestRateTable),
+        unittest.TestLoader().loadTestsFromTestCase(TestUom),
+        unittest.TestLoader().loadTestsFromTestCase(TestRegistry),
+        unittest.TestLoader().loadTestsFromTestCase(TestResponse),
+        unittest.TestLoader().loadTestsFromTestCase(TestConnectionPool),
+        unittest.TestLoader().loadTestsFromTestCase(TestSingleFlight),
+        unittest.TestLoader().loadTestsFromTestCase(TestRetry),
+        unittest.TestLoader().loadTestsFromTestCase(TestRateLimit),
+        unittest.TestLoader().loadTestsFromTestCase(TestSharedRateLimit),
+        unittest.TestLoader().loadTestsFromTestCase(TestCallMetrics),
+        unittest.TestLoader().loadTestsFromTestCase(TestCapture),
+        unittest.TestLoader().loadTestsFromTestCase(TestProfile),
+        unittest.TestLoader().loadTestsFromTestCase(TestSale),
+        unittest.TestLoader().loadTestsFromTestCase(TestShipment),
     ])
     return test_suite
 
@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_api.py
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import httplib
+import socket
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+
+from ups.base import PyUPSException
+
+import trytond.tests.test_tryton
+from trytond.config import CONFIG
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from trytond.modules.ups import api
+from trytond.modules.ups.api import SingleFlight, CircuitBreaker, \
+    CircuitOpenError, call_with_retry, TokenBucket, RateLimiter, \
+    batch_priority, ConnectionPool
+
+
+class UPSHandler(BaseHTTPRequestHandler):
+    """
+    Answer the posts with keep-alive connections, after the delay of the
+    server. If the server says so, the connection is closed after the
+    response without telling the client, as a server closing an idle
+    connection does.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.client_address)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(body)
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.close_idle:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class UPSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), UPSHandler)
+        self.connections = []
+        self.requests = []
+        self.delay = 0
+        self.close_idle = False
+
+    def handle_error(self, request, client_address):
+        # The client gave up waiting
+        pass
+
+
+class UncheckedConnectionPool(ConnectionPool):
+    """
+    Reuse the idle connections without checking them, as if the server
+    closed them right after the check
+    """
+    connection_class = httplib.HTTPConnection
+
+    @staticmethod
+    def _is_healthy(connection):
+        return connection.sock is not None
+
+
+class TestConnectionPool(unittest.TestCase):
+    '''
+    Test the keep-alive connections to UPS
+    '''
+
+    def setUp(self):
+        self.server = UPSServer()
+        self.url = 'http://%s:%s/ups.app/xml/Rate' % \
+            self.server.server_address
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_pool(self, **kwargs):
+        pool = ConnectionPool(**kwargs)
+        pool.connection_class = httplib.HTTPConnection
+        return pool
+
+    def test0010reuse(self):
+        '''
+        Test that the requests share a kept alive connection
+        '''
+        pool = self.get_pool()
+        self.assertEqual(pool.post(self.url, 'first'), 'first')
+        self.assertEqual(pool.post(self.url, 'second'), 'second')
+        self.assertEqual(self.server.requests, ['first', 'second'])
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test0020eviction(self):
+        '''
+        Test that the connections idle for too long or closed by the server
+        are not reused
+        '''
+        pool = self.get_pool(idle_timeout=0)
+        pool.post(self.url, 'first')
+        pool.post(self.url, 'second')
+        self.assertEqual(len(self.server.connections), 2)
+
+        self.server.close_idle = True
+        pool = self.get_pool()
+        pool.post(self.url, 'third')
+        time.sleep(0.05)
+        self.assertEqual(pool.post(self.url, 'fourth'), 'fourth')
+        self.assertEqual(len(self.server.connections), 4)
+        self.assertEqual(len(self.server.requests), 4)
+
+        pool = self.get_pool(max_idle=0)
+        pool.post(self.url, 'fifth')
+        self.assertEqual(pool._idle[pool._idle.keys()[0]], [])
+
+    def test0030retry_stale(self):
+        '''
+        Test that a request on a connection the server closed while it was
+        idle is sent once on a new connection
+        '''
+        self.server.close_idle = True
+        pool = UncheckedConnectionPool()
+        pool.post(self.url, 'first')
+        time.sleep(0.05)
+        self.assertEqual(pool.post(self.url, 'second'), 'second')
+        self.assertEqual(self.server.requests, ['first', 'second'])
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test0040no_retry_timeout(self):
+        '''
+        Test that a request which timed out on a reused connection is not
+        sent again
+        '''
+        pool = self.get_pool()
+        pool.post(self.url, 'first')
+        self.server.delay = 0.3
+        start = time.time()
+        self.assertRaises(
+            socket.timeout, pool.post, self.url, 'second', timeout=0.1
+        )
+        self.assertTrue(time.time() - start < 0.2)
+        time.sleep(0.3)
+        self.assertEqual(self.server.requests, ['first', 'second'])
+        self.assertEqual(len(self.server.connections), 1)
+
+
+class TestSingleFlight(unittest.TestCase):
+    '''
+    Test the coalescing of identical calls
+    '''
+
+    def run_threads(self, single_flight, key, function, count=5):
+        results = []
+
+        def target():
+            try:
+                results.append(single_flight.do(key, function))
+            except Exception, e:
+                results.append(e)
+        threads = [Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test0010coalesce(self):
+        '''
+        Test that concurrent calls with the same key share one call
+        '''
+        single_flight = SingleFlight()
+        calls = []
+
+        def function():
+            calls.append(1)
+            time.sleep(0.2)
+            return [{'TotalCharges': '25.10'}]
+
+        results = self.run_threads(single_flight, 'key', function)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[{'TotalCharges': '25.10'}]] * 5)
+        # Every caller has its own copy
+        self.assertEqual(len(set(id(r) for r in results)), 5)
+
+        # Once done, the next call is made again
+        single_flight.do('key', function)
+        self.assertEqual(len(calls), 2)
+
+    def test0020error(self):
+        '''
+        Test that the error of the call is raised to all the callers
+        '''
+        single_flight = SingleFlight()
+
+        def function():
+            time.sleep(0.2)
+            raise ValueError('UPS is down')
+
+        results = self.run_threads(single_flight, 'key', function)
+        self.assertEqual(len(results), 5)
+        for result in results:
+            self.assertTrue(isinstance(result, ValueError))
+
+    def test0030no_key(self):
+        '''
+        Test that calls without key are never coalesced
+        '''
+        single_flight = SingleFlight()
+        calls = []
+
+        def function():
+            calls.append(1)
+            time.sleep(0.1)
+
+        self.run_threads(single_flight, None, function)
+        self.assertEqual(len(calls), 5)
+
+
+class TestRetry(unittest.TestCase):
+    '''
+    Test the retries and the circuit breaker
+    '''
+
+    def setUp(self):
+        self.backoff_max = api.BACKOFF_MAX
+        api.BACKOFF_MAX = 0
+        api._circuit_breakers.clear()
+
+    def tearDown(self):
+        api.BACKOFF_MAX = self.backoff_max
+        api._circuit_breakers.clear()
+
+    def failing(self, *errors):
+        calls = []
+        errors = list(errors)
+
+        def function():
+            calls.append(1)
+            if errors:
+                raise errors.pop(0)
+            return 'response'
+        return function, calls
+
+    def test0010retry_transient(self):
+        '''
+        Test that network and transient UPS errors are retried
+        '''
+        function, calls = self.failing(
+            socket.error('reset'),
+            PyUPSException('Transient-190001:Try again'),
+        )
+        self.assertEqual(call_with_retry('rate', 'url', function), 'response')
+        self.assertEqual(len(calls), 3)
+
+        function, calls = self.failing(*[socket.error('reset')] * 5)
+        self.assertRaises(
+            socket.error, call_with_retry, 'rate', 'url', function
+        )
+        self.assertEqual(len(calls), api.RETRIES['rate'] + 1)
+
+    def test0020no_retry(self):
+        '''
+        Test that errors of the request and network errors of an accept
+        are not retried
+        '''
+        function, calls = self.failing(PyUPSException('Hard-120:Invalid'))
+        self.assertRaises(
+            PyUPSException, call_with_retry, 'rate', 'url', function
+        )
+        self.assertEqual(len(calls), 1)
+
+        function, calls = self.failing(socket.error('reset'))
+        self.assertRaises(
+            socket.error, call_with_retry, 'accept', 'url', function
+        )
+        self.assertEqual(len(calls), 1)
+
+    def test0030circuit_breaker(self):
+        '''
+        Test that the circuit opens after repeated failures and closes
+        after a successful probe
+        '''
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.1)
+        breaker.before_call()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        time.sleep(0.15)
+        self.assertEqual(breaker.state, 'half-open')
+        breaker.before_call()
+        # Only one probe at a time
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+
+        time.sleep(0.15)
+        breaker.before_call()
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.before_call()
+
+    def test0035failed_probe(self):
+        '''
+        Test that a probe failing on something else than UPS lets another
+        call probe without closing the circuit
+        '''
+        breaker = api.get_circuit_breaker('url')
+        breaker.reset_timeout = 0.1
+
+        for failure in range(api.CIRCUIT_THRESHOLD):
+            breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+
+        time.sleep(0.15)
+        function, calls = self.failing(ValueError('Unparsable response'))
+        self.assertRaises(ValueError, call_with_retry, 'rate', 'url', function)
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(breaker.before_call())
+
+    def test0040fail_fast(self):
+        '''
+        Test that calls fail without calling UPS while the circuit is open,
+        which takes as many failed calls as its threshold whatever their
+        retries
+        '''
+        attempts = api.CIRCUIT_THRESHOLD * (api.RETRIES['rate'] + 1)
+        function, calls = self.failing(*[socket.error('down')] * attempts)
+        for _ in range(api.CIRCUIT_THRESHOLD):
+            self.assertEqual(
+                api.get_circuit_breaker('url').state, 'closed'
+            )
+            self.assertRaises(
+                socket.error, call_with_retry, 'rate', 'url', function
+            )
+        self.assertEqual(len(calls), attempts)
+        self.assertRaises(
+            CircuitOpenError, call_with_retry, 'rate', 'url', function
+        )
+        self.assertEqual(len(calls), attempts)
+
+
+class TestRateLimit(unittest.TestCase):
+    '''
+    Test the limits of the requests rate
+    '''
+
+    def test0010token_bucket(self):
+        '''
+        Test that the bucket lets a burst through, then the rate
+        '''
+        bucket = TokenBucket(20)
+        start = time.time()
+        for _ in range(30):
+            bucket.acquire()
+        # 20 tokens of burst, then 10 more at 20 per second
+        self.assertTrue(0.4 <= time.time() - start < 1)
+
+    def test0020batch_reserve(self):
+        '''
+        Test that batch requests leave the reserve to interactive ones
+        '''
+        bucket = TokenBucket(4)
+        # One token out of four is reserved
+        for _ in range(3):
+            self.assertEqual(bucket.take(batch=True), 0)
+        self.assertTrue(bucket.take(batch=True) > 0)
+        self.assertEqual(bucket.take(), 0)
+
+    def test0030limiter(self):
+        '''
+        Test that the limits are by call type and account
+        '''
+        limiter = RateLimiter()
+        limiter.configure('rate', 'key', 2)
+        limiter.configure('confirm', 'key', None)
+        start = time.time()
+        for _ in range(10):
+            limiter.acquire('confirm', 'key')
+            limiter.acquire('rate', 'other key')
+        self.assertTrue(time.time() - start < 0.1)
+
+        with batch_priority():
+            limiter.acquire('rate', 'key')
+            limiter.acquire('rate', 'key')
+        self.assertTrue(time.time() - start >= 0.2)
+
+    def test0040shared(self):
+        '''
+        Test that a shared bucket takes its tokens through its function,
+        a few at once, with the reserve of the batch requests
+        '''
+        taken = []
+
+        def take_shared(rate, capacity, needed, wanted):
+            taken.append((rate, capacity, needed, wanted))
+            return wanted, 0
+
+        limiter = RateLimiter()
+        limiter.configure('rate', 'key', 8, take_shared)
+        limiter.acquire('rate', 'key')
+        limiter.acquire('rate', 'key')
+        with batch_priority():
+            limiter.acquire('rate', 'key')
+        self.assertEqual(taken, [(8, 8, 1, 2), (8, 8, 3, 2)])
+
+        # The bucket is kept in the process when it can not be shared
+        limiter.configure('rate', 'key', 8)
+        limiter.acquire('rate', 'key')
+        self.assertEqual(len(taken), 2)
+
+    def test0050shared_wait(self):
+        '''
+        Test that a shared bucket waits for its function to grant tokens
+        '''
+        grants = [(0, 0.01), (1, 0)]
+        limiter = RateLimiter()
+        limiter.configure('rate', 'key', 8, lambda *args: grants.pop(0))
+        limiter.acquire('rate', 'key')
+        self.assertEqual(grants, [])
+
+
+class TestSharedRateLimit(unittest.TestCase):
+    '''
+    Test the token buckets shared by the server processes
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('ups')
+        self.RateLimit = POOL.get('ups.rate.limit')
+
+    @unittest.skipIf(
+        CONFIG['db_type'] == 'postgresql', 'The buckets are shared'
+    )
+    def test0010not_shared(self):
+        '''
+        Test that the buckets are kept in the process but on PostgreSQL
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertEqual(self.RateLimit.get_take('rate', 'key'), None)
+
+    @unittest.skipUnless(
+        CONFIG['db_type'] == 'postgresql', 'The buckets are not shared'
+    )
+    def test0020take(self):
+        '''
+        Test that the tokens are taken from the bucket in the database
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            take = self.RateLimit.get_take('rate', 'key')
+        self.assertEqual(take(1, 2, 1, 1), (1, 0))
+        self.assertEqual(take(1, 2, 1, 3), (1, 0))
+        granted, wait = take(1, 2, 1, 1)
+        self.assertEqual(granted, 0)
+        self.assertTrue(0 < wait <= 1)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            bucket, = self.RateLimit.search([('name', '=', 'rate,key')])
+            self.assertTrue(bucket.tokens < 1)
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestConnectionPool)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestSingleFlight)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRetry)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRateLimit)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestSharedRateLimit)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
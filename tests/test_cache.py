@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_cache.py
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import time
+import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from trytond.modules.ups.cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+    '''
+    Test the rate cache
+    '''
+
+    def test0010hit_and_miss(self):
+        '''
+        Test that the counters follow the lookups
+        '''
+        cache = TTLCache()
+        self.assertEqual(cache.get('key'), None)
+        cache.set('key', [1, 2], 60)
+        self.assertEqual(cache.get('key'), [1, 2])
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test0020expiry(self):
+        '''
+        Test that entries are not returned after the time to live
+        '''
+        cache = TTLCache()
+        cache.set('key', 'value', 0.01)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('key', 'default'), 'default')
+        # Still available to fall back on
+        self.assertEqual(cache.get_stale('key'), 'value')
+
+    def test0030lru_eviction(self):
+        '''
+        Test that the least recently used entry is evicted first
+        '''
+        cache = TTLCache(size_limit=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.resize(1)
+        self.assertEqual(cache.stats()['size'], 1)
+
+    def test0040copy(self):
+        '''
+        Test that cached values can not be altered by the callers
+        '''
+        cache = TTLCache()
+        value = cache.set('key', {'a': 1}, 60)
+        value['a'] = 2
+        cache.get('key')['a'] = 3
+        self.assertEqual(cache.get('key'), {'a': 1})
+
+
+class TestRateCache(unittest.TestCase):
+    '''
+    Test the rate cache shared by the workers
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('ups')
+        self.RateCache = POOL.get('ups.rate.cache')
+
+    def test0010get_set(self):
+        '''
+        Test that the rates are stored until they expire
+        '''
+        rates = [['Next Day Air', Decimal('25.10'), 1, {}, {}]]
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertEqual(self.RateCache.get_rates('fingerprint'), None)
+
+            self.RateCache.set_rates('fingerprint', rates, 60)
+            cached, ttl = self.RateCache.get_rates('fingerprint')
+            self.assertEqual(cached, rates)
+            self.assertTrue(59 < ttl <= 60)
+
+            self.RateCache.set_rates('expired', rates, -1)
+            self.assertEqual(self.RateCache.get_rates('expired'), None)
+
+    def test0020insert_only(self):
+        '''
+        Test that the entries are never updated and the last one wins
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.RateCache.set_rates('fingerprint', ['first'], 60)
+            first, = self.RateCache.search([])
+            self.RateCache.set_rates('fingerprint', ['second'], 60)
+            self.assertEqual(len(self.RateCache.search([])), 2)
+            self.assertEqual(first.value, '["first"]')
+            self.assertEqual(
+                self.RateCache.get_rates('fingerprint')[0], ['second']
+            )
+
+    def test0030clean(self):
+        '''
+        Test that the expired and replaced entries are deleted
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.RateCache.set_rates('expired', ['expired'], -1)
+            self.RateCache.set_rates('fingerprint', ['first'], 60)
+            self.RateCache.set_rates('fingerprint', ['second'], 60)
+            self.RateCache.set_rates('other', ['other'], 60)
+            old, = self.RateCache.search([('value', '=', '["first"]')])
+            self.RateCache.write([old], {
+                'expire': datetime.utcnow() + timedelta(seconds=30),
+            })
+
+            self.RateCache.clean()
+            self.assertEqual(
+                sorted(e.value for e in self.RateCache.search([])),
+                ['["other"]', '["second"]']
+            )
+            self.assertEqual(
+                self.RateCache.get_rates('fingerprint')[0], ['second']
+            )
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestTTLCache)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRateCache)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_capture.py
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.modules.ups.capture import strip_xml
+
+
+class TestCapture(unittest.TestCase):
+    '''
+    Test the capture of the requests
+    '''
+
+    def test0010strip_xml(self):
+        '''
+        Test that the credentials and the label images are not stored
+        '''
+        request = (
+            '<AccessRequest><AccessLicenseNumber>KEY</AccessLicenseNumber>'
+            '<UserId>user</UserId><Password>secret</Password>'
+            '</AccessRequest>'
+        )
+        self.assertEqual(strip_xml(request), (
+            u'<AccessRequest><AccessLicenseNumber>...</AccessLicenseNumber>'
+            u'<UserId>...</UserId><Password>...</Password>'
+            u'</AccessRequest>'
+        ))
+
+        response = (
+            '<LabelImage><LabelImageFormat><Code>GIF</Code>'
+            '</LabelImageFormat><GraphicImage>R0lGODlheAUgA+cAAAAAAA=='
+            '</GraphicImage></LabelImage>'
+        )
+        self.assertEqual(strip_xml(response), (
+            u'<LabelImage><LabelImageFormat><Code>GIF</Code>'
+            u'</LabelImageFormat><GraphicImage>...</GraphicImage>'
+            u'</LabelImage>'
+        ))
+        self.assertEqual(strip_xml(None), None)
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestCapture)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
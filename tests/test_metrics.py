@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_metrics.py
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import socket
+import unittest
+
+from ups.base import PyUPSException
+
+import trytond.tests.test_tryton
+from trytond.modules.ups.metrics import CallMetrics, error_code
+
+
+class TestCallMetrics(unittest.TestCase):
+    '''
+    Test the metrics of the requests to UPS
+    '''
+
+    def test0010error_code(self):
+        '''
+        Test the codes the errors are counted by
+        '''
+        self.assertEqual(
+            error_code(PyUPSException('Hard-120802:Address invalid')),
+            '120802'
+        )
+        self.assertEqual(error_code(socket.timeout('timed out')), 'timeout')
+
+    def test0020stats(self):
+        '''
+        Test the histogram and the counters
+        '''
+        metrics = CallMetrics(buckets=(0.1, 1))
+        metrics.observe('rate', 0.05, 1000, 2000)
+        metrics.observe('rate', 0.5, 1000, 4000)
+        metrics.observe('rate', 3, 1000, 3000)
+        metrics.error('rate', PyUPSException('Hard-111:Bad weight'))
+        metrics.error('rate', PyUPSException('Hard-111:Bad weight'))
+
+        stats = metrics.stats()
+        self.assertEqual(stats.keys(), ['rate'])
+        rate = stats['rate']
+        self.assertEqual(rate['count'], 3)
+        self.assertEqual(
+            rate['latency_buckets'], [(0.1, 1), (1, 1), (None, 1)]
+        )
+        self.assertAlmostEqual(rate['latency_sum'], 3.55)
+        self.assertEqual(rate['latency_max'], 3)
+        self.assertEqual(rate['request_bytes'], 3000)
+        self.assertEqual(rate['response_bytes'], 9000)
+        self.assertEqual(rate['response_bytes_max'], 4000)
+        self.assertEqual(rate['errors'], {'111': 2})
+
+        dump = metrics.dump()
+        self.assertTrue(
+            'ups_request_seconds_bucket{call="rate",le="1"} 2\n' in dump
+        )
+        self.assertTrue(
+            'ups_request_seconds_bucket{call="rate",le="+Inf"} 3\n' in dump
+        )
+        self.assertTrue(
+            'ups_errors_total{call="rate",code="111"} 2\n' in dump
+        )
+
+        metrics.reset()
+        self.assertEqual(metrics.stats(), {})
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestCallMetrics)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
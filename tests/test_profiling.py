@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_profiling.py
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import time
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.modules.ups.profiling import Profile
+
+
+class Cursor(object):
+
+    def execute(self, query):
+        return query
+
+
+class TestProfile(unittest.TestCase):
+    '''
+    Test the profiling of the rating and labelling calls
+    '''
+
+    def test0010phases(self):
+        '''
+        Test the time of a phase does not include the nested phases
+        '''
+        profile = Profile('test')
+        with profile.phase('read'):
+            time.sleep(0.05)
+            with profile.phase('network'):
+                time.sleep(0.1)
+                with profile.phase('parse'):
+                    pass
+        report = profile.report()
+
+        self.assertTrue(0.05 <= profile.phases['read'][0] < 0.1)
+        self.assertTrue(0.1 <= profile.phases['network'][0] < 0.15)
+        self.assertTrue(profile.phases['parse'][0] < 0.05)
+        self.assertTrue(report.startswith('test: '))
+        self.assertTrue('read ' in report)
+        self.assertFalse('write ' in report)
+
+    def test0020queries(self):
+        '''
+        Test the queries are counted in the phase executing them
+        '''
+        cursor = Cursor()
+        profile = Profile('test')
+        with profile.count_queries(cursor):
+            cursor.execute('SELECT 1')
+            with profile.phase('write'):
+                self.assertEqual(cursor.execute('UPDATE'), 'UPDATE')
+                cursor.execute('INSERT')
+        cursor.execute('SELECT 2')
+        profile.report()
+
+        self.assertFalse('execute' in cursor.__dict__)
+        self.assertEqual(profile.queries, 3)
+        self.assertEqual(profile.phases['write'][1], 2)
+        self.assertEqual(profile.phases['other'][1], 1)
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestProfile)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_rate_table.py
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import unittest
+from decimal import Decimal
+
+import trytond.tests.test_tryton
+from trytond.modules.ups.rate_table import RateTable
+
+
+class TestRateTable(unittest.TestCase):
+    '''
+    Test the offline rate estimation
+    '''
+
+    def setUp(self):
+        self.rate_table = RateTable([
+            ('03', '004', '005', '006', '009', '2'),
+            ('03', '004', '005', '010', '089', '3'),
+            ('03', '900', '961', '006', '089', '8'),
+        ], [
+            ('03', '2', 1, Decimal('8.00'), 1),
+            ('03', '2', 5, Decimal('10.00'), 1),
+            ('03', '3', 5, Decimal('12.00'), 1),
+            ('03', '8', 5, Decimal('20.00'), 1),
+        ])
+
+    def test0010zone(self):
+        '''
+        Test the zone lookup on the ZIP prefixes
+        '''
+        self.assertEqual(self.rate_table.zone('03', '00501', '00601'), '2')
+        self.assertEqual(self.rate_table.zone('03', '00501', '01001'), '3')
+        self.assertEqual(
+            self.rate_table.zone('03', '94301-1041', '08901'), '8'
+        )
+        self.assertEqual(self.rate_table.zone('03', '00501', '33137'), None)
+        self.assertEqual(self.rate_table.zone('01', '00501', '00601'), None)
+        self.assertEqual(self.rate_table.zone('03', None, '00601'), None)
+
+    def test0020price(self):
+        '''
+        Test that the price of the first weight bracket is used
+        '''
+        self.assertEqual(
+            self.rate_table.price('03', '00501', '00601', 1),
+            (Decimal('8.00'), 1)
+        )
+        self.assertEqual(
+            self.rate_table.price('03', '00501', '00601', 2),
+            (Decimal('10.00'), 1)
+        )
+        self.assertEqual(
+            self.rate_table.price('03', '00501', '00601', 6), None
+        )
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRateTable)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_registry.py
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+
+class TestRegistry(unittest.TestCase):
+    '''
+    Test the cached lookups of UPS services and currencies by code
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('ups')
+        self.UPSService = POOL.get('ups.service')
+        self.Currency = POOL.get('currency.currency')
+
+    def test0010services_by_code(self):
+        '''
+        Test that the services by code follow the changes of the services
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            services = self.UPSService.get_services_by_code()
+            self.assertTrue('01' in services)
+            self.assertFalse('99' in services)
+
+            service, = self.UPSService.create([{
+                'name': 'Test Service',
+                'code': '99',
+            }])
+            self.assertEqual(
+                self.UPSService.get_services_by_code()['99'],
+                (service.id, 'Test Service')
+            )
+
+            self.UPSService.write([service], {'active': False})
+            self.assertFalse('99' in self.UPSService.get_services_by_code())
+
+    def test0020currency_by_code(self):
+        '''
+        Test that the currencies by code follow the changes of the
+        currencies
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertRaises(KeyError, self.Currency.get_by_code, 'XTS')
+
+            currency, = self.Currency.create([{
+                'name': 'Test Currency',
+                'code': 'XTS',
+                'symbol': 'X',
+            }])
+            self.assertEqual(self.Currency.get_by_code('XTS'), currency)
+
+            self.Currency.write([currency], {'code': 'XTT'})
+            self.assertEqual(self.Currency.get_by_code('XTT'), currency)
+            self.assertRaises(KeyError, self.Currency.get_by_code, 'XTS')
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRegistry)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_response.py
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import base64
+import unittest
+
+import trytond.tests.test_tryton
+from ups.base import PyUPSException
+from trytond.modules.ups.response import parse_rate_response, \
+    parse_shipment_response
+
+RATE_RESPONSE = '''<?xml version="1.0"?>
+<RatingServiceSelectionResponse>
+  <Response>
+    <ResponseStatusCode>1</ResponseStatusCode>
+    <Error>
+      <ErrorSeverity>Warning</ErrorSeverity>
+      <ErrorCode>110971</ErrorCode>
+      <ErrorDescription>Rates may differ</ErrorDescription>
+    </Error>
+  </Response>
+  <RatedShipment>
+    <Service><Code>01</Code></Service>
+    <RatedPackage>
+      <TotalCharges>
+        <CurrencyCode>USD</CurrencyCode>
+        <MonetaryValue>1.00</MonetaryValue>
+      </TotalCharges>
+    </RatedPackage>
+    <TotalCharges>
+      <CurrencyCode>USD</CurrencyCode>
+      <MonetaryValue>25.10</MonetaryValue>
+    </TotalCharges>
+    <GuaranteedDaysToDelivery>1</GuaranteedDaysToDelivery>
+    <ScheduledDeliveryTime>10:30 A.M.</ScheduledDeliveryTime>
+    <NegotiatedRates>
+      <NetSummaryCharges>
+        <GrandTotal>
+          <CurrencyCode>USD</CurrencyCode>
+          <MonetaryValue>20.00</MonetaryValue>
+        </GrandTotal>
+      </NetSummaryCharges>
+    </NegotiatedRates>
+  </RatedShipment>
+  <RatedShipment>
+    <Service><Code>03</Code></Service>
+    <TotalCharges>
+      <CurrencyCode>USD</CurrencyCode>
+      <MonetaryValue>9.50</MonetaryValue>
+    </TotalCharges>
+    <GuaranteedDaysToDelivery/>
+  </RatedShipment>
+</RatingServiceSelectionResponse>'''
+
+ERROR_RESPONSE = '''<?xml version="1.0"?>
+<RatingServiceSelectionResponse>
+  <Response>
+    <ResponseStatusCode>0</ResponseStatusCode>
+    <Error>
+      <ErrorSeverity>Hard</ErrorSeverity>
+      <ErrorCode>111285</ErrorCode>
+      <ErrorDescription>The postal code is invalid</ErrorDescription>
+    </Error>
+  </Response>
+</RatingServiceSelectionResponse>'''
+
+ACCEPT_RESPONSE = '''<?xml version="1.0"?>
+<ShipmentAcceptResponse>
+  <Response><ResponseStatusCode>1</ResponseStatusCode></Response>
+  <ShipmentResults>
+    <ShipmentCharges>
+      <TransportationCharges>
+        <CurrencyCode>USD</CurrencyCode>
+        <MonetaryValue>28.00</MonetaryValue>
+      </TransportationCharges>
+      <TotalCharges>
+        <CurrencyCode>USD</CurrencyCode>
+        <MonetaryValue>30.00</MonetaryValue>
+      </TotalCharges>
+    </ShipmentCharges>
+    <ShipmentIdentificationNumber>1Z999</ShipmentIdentificationNumber>
+    <PackageResults>
+      <TrackingNumber>1Z9990001</TrackingNumber>
+      <LabelImage>
+        <LabelImageFormat><Code>GIF</Code></LabelImageFormat>
+        <GraphicImage>%s</GraphicImage>
+      </LabelImage>
+    </PackageResults>
+  </ShipmentResults>
+</ShipmentAcceptResponse>''' % base64.encodestring('GIF89a' * 1000)
+
+
+class TestResponse(unittest.TestCase):
+    '''
+    Test the parsers of the UPS responses
+    '''
+
+    def test0010rate_response(self):
+        '''
+        Test that the values of the rated shipments are extracted
+        '''
+        next_day, ground = parse_rate_response(RATE_RESPONSE)
+        self.assertEqual(next_day, {
+            'ServiceCode': '01',
+            'CurrencyCode': 'USD',
+            'TotalCharges': '25.10',
+            'NegotiatedCharges': '20.00',
+            'ScheduledDeliveryTime': '10:30 A.M.',
+            'GuaranteedDaysToDelivery': 1,
+        })
+        self.assertEqual(ground, {
+            'ServiceCode': '03',
+            'CurrencyCode': 'USD',
+            'TotalCharges': '9.50',
+            'GuaranteedDaysToDelivery': '',
+        })
+
+    def test0020error_response(self):
+        '''
+        Test that an error which is not a warning raises PyUPSException
+        '''
+        try:
+            parse_rate_response(ERROR_RESPONSE, 'request')
+        except PyUPSException, e:
+            self.assertEqual(
+                e[0], 'Hard-111285:The postal code is invalid'
+            )
+            self.assertEqual(e[1], 'request')
+        else:
+            self.fail('PyUPSException not raised')
+
+    def test0030shipment_response(self):
+        '''
+        Test that the charges, numbers and labels of a shipment are
+        extracted
+        '''
+        shipment = parse_shipment_response(ACCEPT_RESPONSE)
+        self.assertEqual(shipment['CurrencyCode'], 'USD')
+        self.assertEqual(shipment['TotalCharges'], '30.00')
+        self.assertEqual(shipment['ShipmentIdentificationNumber'], '1Z999')
+        package, = shipment['Packages']
+        self.assertEqual(package['TrackingNumber'], '1Z9990001')
+        self.assertEqual(
+            base64.decodestring(package['GraphicImage']), 'GIF89a' * 1000
+        )
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestResponse)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
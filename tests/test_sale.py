@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_sale.py
+
+    Test the rating of the sales against a fake UPS.
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import base64
+import re
+import socket
+import time
+import unittest
+from decimal import Decimal
+
+from lxml import etree
+from ups.base import PyUPSException
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.modules.ups import api
+from trytond.modules.ups.cache import rate_cache
+
+from tests.test_ups import TestUPS
+
+RATED_SHIPMENT = (
+    '<RatedShipment><Service><Code>%s</Code></Service>'
+    '<TotalCharges><CurrencyCode>USD</CurrencyCode>'
+    '<MonetaryValue>%s</MonetaryValue></TotalCharges></RatedShipment>'
+)
+SHIPMENT_CHARGES = (
+    '<ShipmentCharges><TotalCharges><CurrencyCode>USD</CurrencyCode>'
+    '<MonetaryValue>30.00</MonetaryValue></TotalCharges></ShipmentCharges>'
+    '<ShipmentIdentificationNumber>1Z999</ShipmentIdentificationNumber>'
+)
+
+
+class FakeUPS(object):
+    """
+    Answer the requests posted to UPS: the rates cost 10 plus the weight
+    of the package and the shipments 30, labelled in `packages` packages.
+    The errors queued in `errors` are raised instead, a None letting the
+    request through.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.errors = []
+        self.packages = 1
+
+    def post(self, url, data, timeout=None):
+        call = url.rsplit('/', 1)[-1]
+        self.requests.append((call, data))
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        if call == 'ShipConfirm':
+            return (
+                '<ShipmentConfirmResponse>%s<ShipmentDigest>DIGEST%s'
+                '</ShipmentDigest></ShipmentConfirmResponse>' % (
+                    SHIPMENT_CHARGES, len(self.requests)
+                )
+            )
+        if call == 'ShipAccept':
+            packages = ''.join(
+                '<PackageResults><TrackingNumber>1Z999TRACK%s%s'
+                '</TrackingNumber><LabelImage><GraphicImage>%s'
+                '</GraphicImage></LabelImage></PackageResults>' % (
+                    len(self.requests), i, base64.encodestring('label')
+                ) for i in range(self.packages)
+            )
+            return (
+                '<ShipmentAcceptResponse><ShipmentResults>%s%s'
+                '</ShipmentResults></ShipmentAcceptResponse>' % (
+                    SHIPMENT_CHARGES, packages
+                )
+            )
+        weight = re.search(r'<Weight>([\d.]+)</Weight>', data).group(1)
+        cost = 10 + Decimal(weight)
+        if '<RequestOption>Shop' in data:
+            rated = RATED_SHIPMENT % ('01', cost) + \
+                RATED_SHIPMENT % ('03', cost / 2)
+        else:
+            rated = RATED_SHIPMENT % ('01', cost)
+        return (
+            '<RatingServiceSelectionResponse><Response>'
+            '<ResponseStatusCode>1</ResponseStatusCode></Response>'
+            '%s</RatingServiceSelectionResponse>' % rated
+        )
+
+    def calls(self, call='Rate'):
+        return len([r for r in self.requests if r[0] == call])
+
+
+class UPSTestCase(TestUPS):
+    """
+    Run the tests of the UPS integration against a fake UPS
+    """
+
+    def setUp(self):
+        self.environ = os.environ.copy()
+        for name in (
+                'UPS_LICENSE_NO', 'UPS_SHIPPER_NO', 'UPS_USER_ID',
+                'UPS_PASSWORD'):
+            os.environ.setdefault(name, 'test')
+        super(UPSTestCase, self).setUp()
+        self.ups = FakeUPS()
+        api.connection_pool.post = self.ups.post
+        self.backoff_max = api.BACKOFF_MAX
+        api.BACKOFF_MAX = 0
+        api._circuit_breakers.clear()
+        rate_cache.clear()
+
+    def tearDown(self):
+        del api.connection_pool.post
+        api.BACKOFF_MAX = self.backoff_max
+        api._circuit_breakers.clear()
+        rate_cache.clear()
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def setup_defaults(self):
+        super(UPSTestCase, self).setup_defaults()
+        # Each test decides whether the rates are cached
+        self.UPSConfiguration.write([self.UPSConfiguration(1)], {
+            'rate_cache_ttl': 0,
+        })
+        del self.ups.requests[:]
+
+    def end_transaction(self):
+        """
+        Forget the rates got by the transaction, as the next quotation
+        would run in a transaction of its own
+        """
+        Transaction().cursor.cache.pop('ups_rates', None)
+
+    def create_draft_sale(self, quantity=1):
+        """
+        Create a sale of quantity of the product shipped with UPS
+        """
+        with Transaction().set_context(company=self.company.id):
+            sale, = self.sale.create([{
+                'payment_term': self.payment_term,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'carrier': self.carrier.id,
+                'ups_service_type': self.ups_service.id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': quantity,
+                    'product': self.product,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': self.product.template.default_uom,
+                }])],
+            }])
+        return sale
+
+    def get_shipping_lines(self, sale):
+        return [l for l in self.sale(sale.id).lines if l.shipment_cost]
+
+
+class TestSale(UPSTestCase):
+    '''
+    Test the rating of the sales
+    '''
+
+    def test0010concurrent(self):
+        '''
+        Test that the sales rated concurrently get the price the carrier
+        gives to the sales rated one by one
+        '''
+        Carrier = POOL.get('carrier')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            get_sale_price = Carrier.get_sale_price
+
+            def get_sale_price_with_fee(carrier):
+                cost, currency_id = get_sale_price(carrier)
+                return cost + 1, currency_id
+            Carrier.get_sale_price = get_sale_price_with_fee
+            try:
+                serial = [self.create_draft_sale(q) for q in (1, 3, 10)]
+                concurrent = [self.create_draft_sale(q) for q in (1, 3, 10)]
+                with Transaction().set_context(company=self.company.id):
+                    for sale in serial:
+                        sale.apply_ups_shipping()
+                    self.end_transaction()
+                    del self.ups.requests[:]
+                    self.sale.apply_ups_shipping_concurrently(concurrent)
+            finally:
+                del Carrier.get_sale_price
+
+            # A single shop request for each sale
+            self.assertEqual(self.ups.calls(), 3)
+            for serial_sale, concurrent_sale in zip(serial, concurrent):
+                serial_line, = self.get_shipping_lines(serial_sale)
+                concurrent_line, = self.get_shipping_lines(concurrent_sale)
+                self.assertEqual(
+                    concurrent_line.unit_price, serial_line.unit_price
+                )
+            self.assertEqual(
+                [self.get_shipping_lines(s)[0].unit_price
+                    for s in concurrent],
+                [Decimal('12'), Decimal('13'), Decimal('16')]
+            )
+
+    def test0020up_to_date(self):
+        '''
+        Test that a sale quoted again without changes is not rated again
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            sale = self.create_draft_sale()
+            with Transaction().set_context(company=self.company.id):
+                self.sale.quote([sale])
+                self.assertEqual(self.ups.calls(), 1)
+                self.assertTrue(self.sale(sale.id).ups_rate_fingerprint)
+
+                self.sale.draft([sale])
+                self.sale.quote([sale])
+                self.assertEqual(self.ups.calls(), 1)
+
+                # Unless the cost is explicitly updated
+                self.end_transaction()
+                self.sale.update_ups_shipment_cost([sale])
+                self.assertEqual(self.ups.calls(), 2)
+
+                # A change of the rated values rates the sale again
+                self.end_transaction()
+                self.sale.draft([sale])
+                self.sale.write([sale], {'ups_saturday_delivery': True})
+                self.sale.quote([sale])
+                self.assertEqual(self.ups.calls(), 3)
+            self.assertEqual(len(self.get_shipping_lines(sale)), 1)
+
+    def test0030update_line(self):
+        '''
+        Test that a new quantity updates the shipping line in place
+        '''
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            sale = self.create_draft_sale()
+            with Transaction().set_context(company=self.company.id):
+                self.sale.quote([sale])
+                line, = self.get_shipping_lines(sale)
+                self.assertEqual(line.unit_price, Decimal('11'))
+
+                self.sale.draft([sale])
+                product_line, = [
+                    l for l in self.sale(sale.id).lines if not l.shipment_cost
+                ]
+                SaleLine.write([product_line], {'quantity': 10})
+                self.sale.quote([sale])
+
+            self.assertEqual(self.ups.calls(), 2)
+            updated_line, = self.get_shipping_lines(sale)
+            self.assertEqual(updated_line.id, line.id)
+            self.assertEqual(updated_line.unit_price, Decimal('15'))
+            self.assertEqual(updated_line.amount, Decimal('15'))
+            self.assertEqual(len(self.sale(sale.id).lines), 2)
+
+    def test0040estimate_fallback(self):
+        '''
+        Test that the rates are estimated when UPS can not be reached
+        '''
+        RateZone = POOL.get('ups.rate.zone')
+        RateChart = POOL.get('ups.rate.chart')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.UPSConfiguration.write([self.UPSConfiguration(1)], {
+                'rate_estimate': 'fallback',
+            })
+            RateZone.create([{
+                'service': self.ups_service.id,
+                'origin_from': '900',
+                'origin_to': '961',
+                'destination_from': '300',
+                'destination_to': '349',
+                'zone': '108',
+            }])
+            RateChart.create([{
+                'service': self.ups_service.id,
+                'zone': '108',
+                'weight': 5,
+                'price': Decimal('42'),
+                'currency': self.company.currency.id,
+            }])
+            sale = self.create_draft_sale()
+
+            # Every attempt fails
+            self.ups.errors = [socket.error('Connection refused')] * 3
+            with Transaction().set_context(company=self.company.id):
+                rates = sale.get_ups_shipping_rates()
+                self.assertEqual(self.ups.calls(), 3)
+                service_id, service_name = \
+                    self.UPSService.get_services_by_code()['01']
+                self.assertEqual(rates, [(
+                    service_name, Decimal('42'), self.company.currency.id,
+                    {'Estimated': True}, {'ups_service_type': service_id},
+                )])
+
+                self.ups.errors = [socket.error('Connection refused')] * 3
+                self.sale.quote([sale])
+            line, = self.get_shipping_lines(sale)
+            self.assertEqual(line.unit_price, Decimal('42'))
+
+    def test0050address_cache(self):
+        '''
+        Test that the cached XML of the addresses follows their changes
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            sale = self.create_draft_sale()
+
+            def get_request():
+                with Transaction().set_context(company=self.company.id):
+                    return etree.tostring(
+                        self.sale(sale.id)._get_rate_request_xml('shop')
+                    )
+            self.assertTrue('<City>Miami, Miami-Dade</City>' in get_request())
+
+            self.party_address.write([sale.shipment_address], {
+                'city': 'Miami Beach',
+            })
+            self.assertTrue('<City>Miami Beach</City>' in get_request())
+
+            phone, = [
+                c for c in self.sale_party.contact_mechanisms
+                if c.type == 'phone'
+            ]
+            self.party_contact.write([phone], {'value': '8005550000'})
+            self.assertTrue(
+                '<PhoneNumber>8005550000</PhoneNumber>' in get_request()
+            )
+
+            self.party.write([self.company.party], {'name': 'New Company'})
+            self.assertTrue(
+                '<CompanyName>New Company</CompanyName>' in get_request()
+            )
+
+            self.country_subdivision.write(
+                [sale.shipment_address.subdivision], {'code': 'US-FX'}
+            )
+            self.assertTrue(
+                '<StateProvinceCode>FX</StateProvinceCode>' in get_request()
+            )
+
+            warehouse_address = self.company.party.addresses[0]
+            self.party_address.write([warehouse_address], {
+                'zip': '94305',
+            })
+            request = get_request()
+            self.assertFalse('94301-1041' in request)
+            self.assertEqual(request.count('<PostalCode>94305</PostalCode>'), 2)
+
+    def test0060rating_failure(self):
+        '''
+        Test that a failed background rating only blocks the confirmation
+        until the sale is rated successfully
+        '''
+        RatingJob = POOL.get('ups.rating.job')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.UPSConfiguration.write([self.UPSConfiguration(1)], {
+                'rate_in_background': True,
+            })
+            sale, other_sale = [self.create_draft_sale() for i in range(2)]
+
+            def get_job_states(sale):
+                return sorted(
+                    j.state for j in RatingJob.search([('sale', '=', sale)])
+                )
+
+            with Transaction().set_context(company=self.company.id):
+                self.sale.quote([sale, other_sale])
+                self.assertEqual(self.ups.calls(), 0)
+                self.assertEqual(
+                    self.sale(sale.id).ups_rating_state, 'pending'
+                )
+
+                # UPS refuses both sales, to shop and to rate their service
+                self.ups.errors = [
+                    PyUPSException('Hard: Invalid address')
+                ] * 5
+                RatingJob.process()
+                self.assertEqual(
+                    [s.ups_rating_state for s in self.sale.browse(
+                        [sale.id, other_sale.id])],
+                    ['failed', 'failed']
+                )
+                self.assertRaises(UserError, self.sale.confirm, [sale])
+
+                # The sale fixed and quoted again is rated on confirmation
+                self.sale.draft([sale])
+                self.sale.write([sale], {'ups_saturday_delivery': True})
+                self.sale.quote([sale])
+                self.assertEqual(
+                    self.sale(sale.id).ups_rating_state, 'pending'
+                )
+                self.sale.confirm([sale])
+                self.assertEqual(self.sale(sale.id).state, 'confirmed')
+                self.assertEqual(self.sale(sale.id).ups_rating_state, 'done')
+                self.assertEqual(get_job_states(sale), ['cancel', 'done'])
+
+                # Updating the cost rates the sale as well
+                self.sale.update_ups_shipment_cost([other_sale])
+                self.assertEqual(
+                    self.sale(other_sale.id).ups_rating_state, 'done'
+                )
+                self.assertEqual(get_job_states(other_sale), ['cancel'])
+                self.sale.confirm([other_sale])
+                self.assertEqual(self.sale(other_sale.id).state, 'confirmed')
+
+    def test0070identical_sales(self):
+        '''
+        Test that the sales with identical requests share a single call
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            sales = [self.create_draft_sale(q) for q in (1, 1, 3)]
+            with Transaction().set_context(company=self.company.id):
+                rates = self.sale.get_ups_shipping_rates_many(sales)
+
+            self.assertEqual(self.ups.calls(), 2)
+            self.assertEqual(rates[sales[0].id], rates[sales[1].id])
+            self.assertNotEqual(rates[sales[0].id], rates[sales[2].id])
+
+    def test0080unreachable(self):
+        '''
+        Test that the cost falls back on the expired rates when UPS can not
+        be reached, else fails with a user error
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.UPSConfiguration.write([self.UPSConfiguration(1)], {
+                'rate_cache_ttl': 1,
+            })
+            rate_cache.clear()
+            sale = self.create_draft_sale()
+            with Transaction().set_context(company=self.company.id):
+                self.assertEqual(
+                    sale.get_ups_shipping_cost(),
+                    (Decimal('11'), self.company.currency.id)
+                )
+                time.sleep(1.1)
+
+                self.ups.errors = [socket.error('Connection refused')] * 3
+                self.assertEqual(
+                    sale.get_ups_shipping_cost(),
+                    (Decimal('11'), self.company.currency.id)
+                )
+                self.assertEqual(self.ups.calls(), 4)
+
+                rate_cache.clear()
+                self.ups.errors = [socket.error('Connection refused')] * 3
+                with self.assertRaises(UserError) as cm:
+                    sale.get_ups_shipping_cost()
+                self.assertEqual(cm.exception.message, 'Connection refused')
+
+                # UPS is not even called while the circuit is open
+                for breaker in api._circuit_breakers.values():
+                    for failure in range(api.CIRCUIT_THRESHOLD):
+                        breaker.failure()
+                with self.assertRaises(UserError) as cm:
+                    sale.get_ups_shipping_cost()
+                self.assertEqual(
+                    cm.exception.message, 'UPS is unavailable, retry later.'
+                )
+            self.assertEqual(self.ups.calls(), 7)
+
+    def test0090rates_then_cost(self):
+        '''
+        Test that the cost reuses the shop rates of the quotation with the
+        rate cache disabled, and asks the rate of the service when UPS
+        refuses to shop
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            sale = self.create_draft_sale()
+            refused = self.create_draft_sale(3)
+            with Transaction().set_context(company=self.company.id):
+                sale.get_ups_shipping_rates()
+                self.assertEqual(
+                    sale.get_ups_shipping_cost(),
+                    (Decimal('11'), self.company.currency.id)
+                )
+                self.assertEqual(self.ups.calls(), 1)
+
+                self.ups.errors = [PyUPSException('Hard: No shop')]
+                self.assertEqual(
+                    refused.get_ups_shipping_cost(),
+                    (Decimal('12'), self.company.currency.id)
+                )
+            self.assertEqual(self.ups.calls(), 3)
+
+    def test0100carrier_rates_many(self):
+        '''
+        Test that the carrier rates together the sales of UPS carriers only
+        '''
+        Carrier = POOL.get('carrier')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            other_carrier, = Carrier.create([{
+                'party': self.carrier.party.id,
+                'carrier_product': self.carrier.carrier_product.id,
+                'carrier_cost_method': 'product',
+            }])
+            sales = [self.create_draft_sale(q) for q in (1, 3, 10)]
+            self.sale.write([sales[2]], {'carrier': other_carrier.id})
+            with Transaction().set_context(company=self.company.id):
+                rates = Carrier.get_rates_many(self.sale.browse(sales))
+
+            self.assertEqual(self.ups.calls(), 2)
+            self.assertEqual(sorted(rates), sorted(s.id for s in sales))
+            self.assertTrue(rates[sales[0].id])
+            self.assertTrue(rates[sales[1].id])
+            self.assertEqual(rates[sales[2].id], [])
+
+    def test0110capture_clean(self):
+        '''
+        Test that only the most recent captures are kept
+        '''
+        Capture = POOL.get('ups.capture')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            sale = self.create_draft_sale()
+            size = self.UPSConfiguration.get_snapshot().capture_size
+            Capture.create([{
+                'call': 'rate',
+                'resource': '%s,%s' % (sale.__name__, sale.id),
+                'request': str(i),
+            } for i in range(size + 1)])
+
+            Capture.clean()
+            self.assertEqual(Capture.search([], count=True), size)
+            self.assertFalse(Capture.search([('request', '=', '0')]))
+            Capture.clean()
+            self.assertEqual(Capture.search([], count=True), size)
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestSale)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
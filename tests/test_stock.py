@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_stock.py
+
+    Test the labels of the shipments against a fake UPS.
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import socket
+import unittest
+
+from ups.base import PyUPSException
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+
+from tests.test_sale import UPSTestCase
+
+
+class TestShipment(UPSTestCase):
+    '''
+    Test the labels of the shipments
+    '''
+
+    def setup_defaults(self):
+        super(TestShipment, self).setup_defaults()
+        # The requests are sent in order so the errors hit known shipments
+        self.UPSConfiguration.write([self.UPSConfiguration(1)], {
+            'rating_workers': 1,
+        })
+
+    def create_shipments(self, count):
+        """
+        Return count shipments of sales to the sale party, in order
+        """
+        for i in range(count - 1):
+            self.create_sale(self.sale_party)
+        del self.ups.requests[:]
+        return self.stock_shipment_out.search([], order=[('id', 'ASC')])
+
+    def test0010generate_many(self):
+        '''
+        Test that the wizard reports the label or the error of each
+        shipment
+        '''
+        GenerateUPSLabel = POOL.get('generate.ups.label', type='wizard')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            shipments = self.create_shipments(3)
+            refused, labelled, waiting = shipments
+            self.stock_shipment_out.assign([refused, labelled])
+            self.stock_shipment_out.pack([refused, labelled])
+
+            self.ups.errors = [PyUPSException('Hard: Invalid address')]
+            session_id, _, _ = GenerateUPSLabel.create()
+            with Transaction().set_context(
+                    company=self.company.id,
+                    active_ids=[s.id for s in shipments]):
+                values = GenerateUPSLabel(session_id).default_start(None)
+
+            self.assertEqual(self.ups.calls('ShipConfirm'), 2)
+            self.assertEqual(self.ups.calls('ShipAccept'), 1)
+            refused, labelled, waiting = self.stock_shipment_out.browse(
+                shipments
+            )
+            self.assertFalse(refused.tracking_number)
+            self.assertTrue(labelled.tracking_number)
+            self.assertFalse(waiting.tracking_number)
+            self.assertEqual(values['report'].split('\n'), [
+                u'%s: Hard: Invalid address' % refused.rec_name,
+                u'%s: %s' % (labelled.rec_name, labelled.tracking_number),
+                u'%s: %s' % (
+                    waiting.rec_name,
+                    self.stock_shipment_out._error_messages['invalid_state']
+                ),
+            ])
+            self.assertEqual(self.ir_attachment.search([
+                ('resource', '=', 'stock.shipment.out,%s' % labelled.id),
+            ], count=True), 1)
+
+    def test0020digest_reuse(self):
+        '''
+        Test that the digest of a shipment is reused after a failed accept
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            shipment, = self.create_shipments(1)
+            self.stock_shipment_out.assign([shipment])
+            self.stock_shipment_out.pack([shipment])
+
+            with Transaction().set_context(company=self.company.id):
+                # The accept is not retried as it is not idempotent
+                self.ups.errors = [None, socket.error('Connection reset')]
+                self.assertRaises(UserError, shipment.make_ups_labels)
+                self.assertEqual(self.ups.calls('ShipConfirm'), 1)
+                self.assertEqual(self.ups.calls('ShipAccept'), 1)
+                self.assertEqual(
+                    self.stock_shipment_out(shipment.id).ups_shipment_digest,
+                    'DIGEST1'
+                )
+
+                tracking_number = shipment.make_ups_labels()
+            self.assertEqual(self.ups.calls('ShipConfirm'), 1)
+            self.assertEqual(self.ups.calls('ShipAccept'), 2)
+            shipment = self.stock_shipment_out(shipment.id)
+            self.assertEqual(shipment.tracking_number, tracking_number)
+            self.assertFalse(shipment.ups_shipment_digest)
+
+    def test0030digest_expiry(self):
+        '''
+        Test that a shipment is confirmed again when UPS refuses its
+        digest or the shipment changed
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            shipment, = self.create_shipments(1)
+            self.stock_shipment_out.assign([shipment])
+            self.stock_shipment_out.pack([shipment])
+
+            with Transaction().set_context(company=self.company.id):
+                self.assertEqual(
+                    self.stock_shipment_out.confirm_ups_labels([shipment]),
+                    {shipment.id: None}
+                )
+                self.ups.errors = [
+                    PyUPSException('Hard: The digest expired')
+                ]
+                self.assertRaises(UserError, shipment.make_ups_labels)
+                self.assertEqual(self.ups.calls('ShipConfirm'), 1)
+                self.assertFalse(
+                    self.stock_shipment_out(shipment.id).ups_shipment_digest
+                )
+
+                self.stock_shipment_out.confirm_ups_labels([shipment])
+                self.assertEqual(self.ups.calls('ShipConfirm'), 2)
+                self.stock_shipment_out.write([shipment], {
+                    'ups_saturday_delivery': False,
+                })
+                self.stock_shipment_out(shipment.id).make_ups_labels()
+            self.assertEqual(self.ups.calls('ShipConfirm'), 3)
+            self.assertEqual(self.ups.calls('ShipAccept'), 2)
+            self.assertTrue(
+                self.stock_shipment_out(shipment.id).tracking_number
+            )
+
+    def test0040several_packages(self):
+        '''
+        Test that a shipment accepted with several packages keeps its
+        tracking number and labels and is not sent to UPS again
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            shipment, = self.create_shipments(1)
+            self.stock_shipment_out.assign([shipment])
+            self.stock_shipment_out.pack([shipment])
+
+            self.ups.packages = 2
+            with Transaction().set_context(company=self.company.id):
+                self.assertEqual(shipment.make_ups_labels(), u'1Z999')
+                shipment = self.stock_shipment_out(shipment.id)
+                self.assertEqual(shipment.tracking_number, u'1Z999')
+                self.assertFalse(shipment.ups_shipment_digest)
+                self.assertEqual(self.ir_attachment.search([
+                    ('resource', '=', 'stock.shipment.out,%s' % shipment.id),
+                ], count=True), 2)
+
+                self.assertRaises(UserError, shipment.make_ups_labels)
+            self.assertEqual(self.ups.calls('ShipConfirm'), 1)
+            self.assertEqual(self.ups.calls('ShipAccept'), 1)
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestShipment)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
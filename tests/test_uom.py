@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_uom.py
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+
+class TestUom(unittest.TestCase):
+    '''
+    Test the cached UOM conversion factors
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('ups')
+        self.Uom = POOL.get('product.uom')
+
+    def test0010compute_qty_by_factor(self):
+        '''
+        Test that the conversion factors give the result of compute_qty
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            uoms = self.Uom.search([])
+            for from_uom in uoms:
+                for to_uom in uoms:
+                    if from_uom.category != to_uom.category:
+                        continue
+                    for qty in (1, 2.5, 1000):
+                        self.assertAlmostEqual(
+                            self.Uom.compute_qty_by_factor(
+                                from_uom, qty, to_uom
+                            ),
+                            self.Uom.compute_qty(from_uom, qty, to_uom)
+                        )
+
+    def test0020invalidation(self):
+        '''
+        Test that the conversion factors follow the new UOMs
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kilogram, = self.Uom.search([('symbol', '=', 'kg')])
+            self.Uom.get_conversion_factors()
+            ton, = self.Uom.create([{
+                'name': 'Test Ton',
+                'symbol': 'tt',
+                'category': kilogram.category.id,
+                'factor': 1000,
+                'rate': 0.001,
+            }])
+            self.assertTrue(
+                (ton.id, kilogram.id) in self.Uom.get_conversion_factors()
+            )
+            self.assertEqual(
+                self.Uom.compute_qty_by_factor(ton, 2, kilogram), 2000
+            )
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestUom)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+    tools.py
+
+    Helpers shared by the models of the module.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from contextlib import contextmanager
+
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+
+__all__ = ['autonomous_transaction']
+
+
+@contextmanager
+def autonomous_transaction():
+    """
+    Run the block in a transaction of its own on a new connection, committed
+    at the end of the block, so that what it writes outlives a rollback of
+    the current transaction. The block must not wait for the rows the
+    current transaction locks.
+
+    SQLite shares a single connection between the cursors, so the block
+    runs in the current transaction there.
+
+    :return: True if the block runs in a transaction of its own
+    """
+    if CONFIG['db_type'] == 'sqlite':
+        yield False
+        return
+    with Transaction().new_cursor() as transaction:
+        yield True
+        transaction.cursor.commit()